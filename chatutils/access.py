@@ -0,0 +1,88 @@
+# Description: Cached access lists (whitelist and banlist) for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Access")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import os
+import time
+import codecs
+
+
+class AccessList:
+    '''
+    Set of user IDs read from a text file (one ID per line)
+    The file is read again only if its modification time or size was changed,
+    the file is checked at most once per `check_interval` seconds.
+    '''
+    def __init__(self, location, check_interval=1.0):
+        self.location = location
+        self.check_interval = check_interval
+        self.ids = set()
+        self.signature = None
+        self.checked = 0
+        self.reload()
+
+    def stat(self):
+        try:
+            st = os.stat(self.location)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def reload(self) -> None:
+        '''
+        Read the file again if it was changed
+        '''
+        self.checked = time.monotonic()
+        signature = self.stat()
+        if signature == self.signature:
+            return None
+        try:
+            ids = set()
+            if signature is not None:
+                with codecs.open(self.location, "r", "utf-8") as f:
+                    for line in f:
+                        line = line.strip()
+                        if line:
+                            ids.add(line)
+            else:
+                logger.warning(f'No {self.location} file or it is not possible to read it')
+            self.ids = ids
+            self.signature = signature
+            logger.debug(f'Loaded {len(self.ids)} IDs from {self.location}')
+        except Exception as e:
+            logger.exception(f'Could not read {self.location}')
+
+    def __contains__(self, user_id) -> bool:
+        if time.monotonic() - self.checked >= self.check_interval:
+            self.reload()
+        return str(user_id) in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, user_id) -> None:
+        '''
+        Add user ID to the file and to the set
+        '''
+        with codecs.open(self.location, "a", "utf-8") as f:
+            f.write(str(user_id)+'\n')
+        self.ids.add(str(user_id))
+        # the file was changed by us, no need to read it again
+        self.signature = self.stat()
@@ -0,0 +1,187 @@
+# Description: Content-addressed storage for images kept in chat history
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Blobs")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import os
+import base64
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+BLOB_PREFIX = 'blob:sha256:'
+
+
+class BlobStore:
+    '''
+    Images are saved once in `location` under their SHA-256 hash (./data/blobs/ab/abcdef...),
+    chat history keeps only a reference:
+        {"type": "image_url", "image_url": {"url": "blob:sha256:<hash>", "media_type": "image/jpeg"}}
+    References are resolved to base64 data URLs only when a request is sent to the API.
+    Disk is read and written in threads, images that are not referenced anymore are removed by `collect`.
+    '''
+    def __init__(self, location="./data/blobs", cache_bytes=32 * 1024 * 1024):
+        self.location = location
+        os.makedirs(self.location, exist_ok=True)
+        # base64 of recently sent images (the same image is sent with every request of a chat)
+        self.cache = OrderedDict()
+        self.cache_bytes = max(int(cache_bytes), 0)
+        self.cached_bytes = 0
+
+    def path(self, digest) -> str:
+        return os.path.join(self.location, digest[:2], digest)
+
+    def put(self, data) -> str:
+        '''
+        Save bytes (if not saved yet) and return reference to them
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            logger.debug(f'Saved blob {digest} ({len(data)} bytes)')
+        return BLOB_PREFIX + digest
+
+    def get(self, ref) -> bytes:
+        '''
+        Read bytes by reference
+        '''
+        with open(self.path(ref[len(BLOB_PREFIX):]), "rb") as f:
+            return f.read()
+
+    def read_b64(self, ref) -> str:
+        return base64.b64encode(self.get(ref)).decode('utf-8')
+
+    async def get_b64(self, ref) -> str:
+        '''
+        Read base64 of bytes by reference (cached up to `cache_bytes`, least recently used are dropped first)
+        '''
+        data = self.cache.get(ref)
+        if data is not None:
+            self.cache.move_to_end(ref)
+            return data
+        data = await asyncio.to_thread(self.read_b64, ref)
+        if len(data) <= self.cache_bytes:
+            self.cache[ref] = data
+            self.cached_bytes += len(data)
+            while self.cached_bytes > self.cache_bytes:
+                _, dropped = self.cache.popitem(last=False)
+                self.cached_bytes -= len(dropped)
+        return data
+
+    async def image_url(self, image_b64, media_type="image/jpeg") -> dict:
+        '''
+        Save base64 image and return `image_url` part of a message with reference to it
+        '''
+        ref = await asyncio.to_thread(self.put, base64.b64decode(image_b64))
+        return {"url": ref, "media_type": media_type}
+
+    async def resolve_image(self, image_url):
+        '''
+        Get media type and base64 data of an `image_url` part of a message (reference or data URL)
+        '''
+        url = image_url['url']
+        if url.startswith(BLOB_PREFIX):
+            return image_url.get('media_type', 'image/jpeg'), await self.get_b64(url)
+        return url.split(';base64,')[0].split(':')[1], url.split(';base64,')[1]
+
+    def digest(self, image_url) -> str:
+        '''
+        SHA-256 of image content of an `image_url` part of a message (reference or data URL)
+        '''
+        url = image_url['url']
+        if url.startswith(BLOB_PREFIX):
+            return url[len(BLOB_PREFIX):]
+        return hashlib.sha256(base64.b64decode(url.split(';base64,')[1])).hexdigest()
+
+    async def resolve_url(self, image_url) -> dict:
+        '''
+        Get `image_url` part of a message with data URL instead of reference
+        '''
+        if not image_url['url'].startswith(BLOB_PREFIX):
+            return image_url
+        media_type, data = await self.resolve_image(image_url)
+        return {"url": f"data:{media_type};base64,{data}"}
+
+    async def resolve_messages(self, messages) -> list:
+        '''
+        Get messages with references replaced by data URLs (for OpenAI API)
+        Only messages with references are copied, chat history is not changed
+        '''
+        resolved = []
+        for message in messages:
+            content = message.get('content')
+            if type(content) == list and any(part.get('type') == 'image_url' and part['image_url']['url'].startswith(BLOB_PREFIX) for part in content):
+                message = dict(message)
+                message['content'] = [
+                    dict(part, image_url=await self.resolve_url(part['image_url'])) if part.get('type') == 'image_url' else part
+                    for part in content
+                ]
+            resolved.append(message)
+        return resolved
+
+    def collect(self, messages) -> int:
+        '''
+        Mark and sweep: delete images that are not referenced by any of the messages
+        (all stored chats and saved sessions, see ChatStore.all_messages), runs in a thread on start
+        Returns number of deleted images
+        '''
+        paths = [os.path.join(root, name) for root, _, names in os.walk(self.location) for name in names]
+        if not paths:
+            return 0
+        referenced = set()
+        for message in messages:
+            content = message.get('content')
+            if type(content) == list:
+                for part in content:
+                    if type(part) == dict and part.get('type') == 'image_url' and part['image_url']['url'].startswith(BLOB_PREFIX):
+                        referenced.add(part['image_url']['url'][len(BLOB_PREFIX):])
+        deleted, size = 0, 0
+        for path in paths:
+            if os.path.basename(path) in referenced:
+                continue
+            try:
+                size += os.path.getsize(path)
+                os.remove(path)
+                deleted += 1
+                if not os.listdir(os.path.dirname(path)):
+                    os.rmdir(os.path.dirname(path))
+            except OSError as e:
+                logger.warning(f'Could not delete blob {path}: {e}')
+        logger.info(f'Deleted {deleted} images that are not referenced anymore ({size} bytes), {len(referenced)} images are kept')
+        return deleted
+
+
+blob_store = None
+
+def get_blob_store():
+    '''
+    Get shared blob store (location can be set in [Storage] section)
+    '''
+    global blob_store
+    if blob_store is None:
+        blob_store = BlobStore(
+            location=config.get("Storage", "BlobsLocation", fallback="./data/blobs"),
+            cache_bytes=config.getint("Storage", "BlobCacheBytes", fallback=32 * 1024 * 1024),
+        )
+    return blob_store
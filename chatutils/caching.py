@@ -0,0 +1,214 @@
+# Description: In-memory caches for SirChatalot
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+
+class LRUCache:
+    '''
+    Dictionary with limited number of items, least recently used items are dropped first
+    '''
+    def __init__(self, maxsize=10000):
+        self.maxsize = max(int(maxsize), 1)
+        self.items = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value) -> None:
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def clear(self) -> None:
+        self.items.clear()
+
+    def __contains__(self, key) -> bool:
+        return key in self.items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def info(self) -> dict:
+        '''
+        Cache statistics
+        '''
+        total = self.hits + self.misses
+        return {
+            'size': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0,
+        }
+
+
+class TTLCache(LRUCache):
+    '''
+    LRU cache with expiration time of items (`ttl` seconds)
+    Keys should be strings and values JSON-serializable to save the cache to disk
+    '''
+    def __init__(self, maxsize=1000, ttl=3600):
+        super().__init__(maxsize)
+        self.ttl = ttl
+        self.expired = 0
+
+    def get(self, key, default=None):
+        item = self.items.get(key)
+        if item is not None and item[0] <= time.time():
+            del self.items[key]
+            self.expired += 1
+            item = None
+        if item is None:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value, ttl=None) -> None:
+        super().put(key, (time.time() + (ttl if ttl is not None else self.ttl), value))
+
+    def pop(self, key, default=None):
+        item = self.items.pop(key, None)
+        return item[1] if item is not None else default
+
+    def __contains__(self, key) -> bool:
+        item = self.items.get(key)
+        return item is not None and item[0] > time.time()
+
+    def info(self) -> dict:
+        info = super().info()
+        info['expired'] = self.expired
+        return info
+
+    def save(self, location) -> None:
+        '''
+        Save items that are not expired yet (atomically)
+        '''
+        now = time.time()
+        items = [[key, expires, value] for key, (expires, value) in self.items.items() if expires > now]
+        os.makedirs(os.path.dirname(location) or '.', exist_ok=True)
+        tmp_location = f'{location}.{os.getpid()}.tmp'
+        with open(tmp_location, 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False)
+        os.replace(tmp_location, location)
+
+    def load(self, location) -> int:
+        '''
+        Load items saved with `save` (expired items are skipped), returns number of loaded items
+        '''
+        if not os.path.exists(location):
+            return 0
+        with open(location, 'r', encoding='utf-8') as f:
+            items = json.load(f)
+        now = time.time()
+        for key, expires, value in items:
+            if expires > now:
+                self.items[key] = (expires, value)
+        # the oldest items are dropped if cache became smaller
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+        return len(self.items)
+
+
+class AsyncCache:
+    '''
+    Cache of results of async calls
+        * LRU in memory (`maxsize` items)
+        * optional tier on disk (`location` directory, one JSON file per key)
+        * concurrent calls with the same key share one call (in-flight coalescing)
+    Keys should be strings and values JSON-serializable, None results are not cached
+    '''
+    def __init__(self, maxsize=1000, location=None):
+        self.memory = LRUCache(maxsize)
+        self.location = location
+        self.in_flight = {}
+        self.disk_hits = 0
+        self.coalesced = 0
+        if self.location is not None:
+            os.makedirs(self.location, exist_ok=True)
+
+    def path(self, key) -> str:
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.location, digest[:2], f'{digest}.json')
+
+    def read(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def write(self, key, value) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    async def call(self, key, func, *args, **kwargs):
+        '''
+        Get value from disk or call `func`, cache the result (runs as a separate task)
+        '''
+        try:
+            value, cached = None, False
+            if self.location is not None:
+                value = await asyncio.to_thread(self.read, key)
+                cached = value is not None
+                self.disk_hits += cached
+            if value is None:
+                value = await func(*args, **kwargs)
+            if value is not None:
+                self.memory.put(key, value)
+                if self.location is not None and not cached:
+                    await asyncio.to_thread(self.write, key, value)
+            return value, cached
+        finally:
+            del self.in_flight[key]
+
+    async def get_or_call(self, key, func, *args, **kwargs):
+        '''
+        Get cached value or call `await func(*args, **kwargs)` and cache its result
+        Returns (value, cached), `cached` is False only for the call that actually called `func`
+        The call runs in its own task: if a caller is cancelled, other callers waiting
+        for the same key still get the result
+        '''
+        value = self.memory.get(key)
+        if value is not None:
+            return value, True
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            value, _ = await asyncio.shield(task)
+            return value, True
+        task = asyncio.ensure_future(self.call(key, func, *args, **kwargs))
+        # error is raised to callers, do not warn about it if all of them were cancelled
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        self.in_flight[key] = task
+        return await asyncio.shield(task)
+
+    def info(self) -> dict:
+        '''
+        Cache statistics
+        '''
+        info = self.memory.info()
+        info['disk_hits'] = self.disk_hits
+        info['coalesced'] = self.coalesced
+        return info
@@ -24,6 +24,198 @@ import hashlib
 import tiktoken
 import asyncio
 import json
+import functools
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from chatutils.blobs import get_blob_store
+from chatutils.caching import LRUCache, AsyncCache
+import inspect
+
+######## Token counting ########
+
+# tiktoken releases the GIL while encoding, so encoding in threads does not block the event loop
+# all token counting goes through this one pool, every call submits a whole batch of texts
+token_threads = max(config.getint("Storage", "TokenThreads", fallback=2), 1)
+token_executor = ThreadPoolExecutor(max_workers=token_threads, thread_name_prefix="tiktoken")
+
+def encode_lengths(encoding, texts) -> list:
+    return [len(encoding.encode_ordinary(text)) for text in texts]
+
+class TokenCounter:
+    '''
+    Count tokens in messages with tiktoken, every message is encoded only once
+    Counts of text messages are cached by (role, content), Python caches hash of str objects,
+    so messages that were already counted cost only a dictionary lookup.
+    Counts of other messages (images, tool calls and results) are cached by the encoded text.
+    Messages that were not counted yet are encoded in a thread pool with one batch call,
+    small inputs (less than `sync_chars` characters) are encoded right away.
+    '''
+    def __init__(self, encoding, maxsize=None, sync_chars=None):
+        self.encoding = encoding
+        maxsize = maxsize if maxsize is not None else config.getint("Storage", "TokenCacheSize", fallback=20000)
+        self.sync_chars = sync_chars if sync_chars is not None else config.getint("Storage", "TokenSyncChars", fallback=2000)
+        self.cache = LRUCache(maxsize=maxsize)
+
+    async def encode(self, texts) -> list:
+        '''
+        Number of tokens in every text
+        '''
+        if sum(len(text) for text in texts) < self.sync_chars:
+            return encode_lengths(self.encoding, texts)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(token_executor, encode_lengths, self.encoding, texts)
+
+    async def tokens(self, text) -> list:
+        '''
+        Tokens of a text (encoded in the thread pool)
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(token_executor, self.encoding.encode_ordinary, text)
+
+    async def count_messages(self, messages) -> list:
+        '''
+        Number of tokens in every message
+        '''
+        counts, keys, missing = [], [], []
+        for i, message in enumerate(messages):
+            content = message.get('content')
+            # text content is keyed by (role, content), other content (images, tool calls and results)
+            # by the text that is encoded - it is built again, but not encoded again
+            key = (message['role'], content) if type(content) == str else f"{message['role']}: {content}"
+            tokens = self.cache.get(key)
+            if tokens is None:
+                missing.append(i)
+            counts.append(tokens)
+            keys.append(key)
+        if missing:
+            texts = [keys[i] if type(keys[i]) == str else f"{keys[i][0]}: {keys[i][1]}" for i in missing]
+            for i, tokens in zip(missing, await self.encode(texts)):
+                counts[i] = tokens
+                self.cache.put(keys[i], tokens)
+        return counts
+
+    async def count(self, messages) -> int:
+        '''
+        Number of tokens in messages
+        '''
+        return sum(await self.count_messages(messages))
+
+######## Prompt cache statistics ########
+
+class PromptCacheStats:
+    '''
+    Share of prompt tokens that were read from provider prompt cache
+    (shows if prefix of requests - system message, tools, history - is stable between turns)
+    '''
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def add(self, prompt_tokens, cached_tokens) -> None:
+        '''
+        Add usage of one request (prompt_tokens include cached tokens)
+        '''
+        self.requests += 1
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        if prompt_tokens:
+            logger.debug(f'Prompt tokens: {prompt_tokens}, cached: {cached_tokens} ({cached_tokens / prompt_tokens:.0%}), total: {self.ratio():.0%}')
+
+    def ratio(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0
+
+    def info(self) -> dict:
+        return {
+            'requests': self.requests,
+            'prompt_tokens': self.prompt_tokens,
+            'cached_tokens': self.cached_tokens,
+            'cached_ratio': round(self.ratio(), 3),
+        }
+
+######## Summary cache ########
+
+# summaries of the same text (URL content, files, chunks) are made once, SummaryCacheSize = 0 disables the cache
+summary_cache_size = config.getint("Storage", "SummaryCacheSize", fallback=1000)
+summary_cache = AsyncCache(
+    maxsize=summary_cache_size,
+    location=config.get("Storage", "SummaryCacheLocation", fallback=None),
+) if summary_cache_size > 0 else None
+
+def cached_summary(func):
+    '''
+    Cache summaries of engine by (engine, model, size, hash of text)
+    Concurrent requests of the same summary share one API call, cached summaries use no tokens
+    '''
+    default_size = inspect.signature(func).parameters['size'].default
+    @functools.wraps(func)
+    async def wrapped(self, text, size=default_size):
+        if summary_cache is None:
+            return await func(self, text, size=size)
+        model = getattr(self, 'summary_model', None) or getattr(self, 'model', None)
+        key = f'{type(self).__name__}:{model}:{size}:{hashlib.sha256(str(text).encode("utf-8")).hexdigest()}'
+        token_usage = {"prompt": 0, "completion": 0}
+        async def summarize():
+            summary, usage = await func(self, text, size=size)
+            token_usage.update(usage)
+            return summary
+        summary, cached = await summary_cache.get_or_call(key, summarize)
+        if cached:
+            logger.debug(f'Summary was found in cache: {key}')
+        return summary, token_usage
+    return wrapped
+
+######## Image description cache ########
+
+# descriptions are cached by image content, so every unique image is described only once (by any engine)
+image_description_cache_size = config.getint("Storage", "ImageDescriptionCacheSize", fallback=1000)
+image_description_cache = AsyncCache(
+    maxsize=image_description_cache_size,
+    location=config.get("Storage", "ImageDescriptionCacheLocation", fallback=None),
+) if image_description_cache_size > 0 else None
+
+def find_image(message):
+    '''
+    First `image_url` part of a message (None if there are no images)
+    '''
+    if 'content' in message and type(message['content']) == list:
+        for part in message['content']:
+            if part.get('type') == 'image_url':
+                return part['image_url']
+    return None
+
+def cached_image_description(func):
+    '''
+    Cache image descriptions by SHA-256 of image content
+    Concurrent requests for the same image share one API call, cached descriptions use no tokens
+    '''
+    @functools.wraps(func)
+    async def wrapped(self, message, user_id=None):
+        image_url = find_image(message) if self.vision else None
+        if image_description_cache is None or image_url is None:
+            return await func(self, message, user_id=user_id)
+        key = f'image:{get_blob_store().digest(image_url)}'
+        token_usage = {"prompt": 0, "completion": 0}
+        async def describe():
+            description, usage = await func(self, message, user_id=user_id)
+            token_usage.update(usage)
+            return description
+        description, cached = await image_description_cache.get_or_call(key, describe)
+        if cached:
+            logger.debug(f'Image description was found in cache: {key}')
+        return description, token_usage
+    return wrapped
+
+async def describe_images(engine, messages) -> list:
+    '''
+    Describe images in messages concurrently (messages without images are not sent)
+    Returns list of (description or None, token_usage) for every message
+    '''
+    async def describe(message):
+        if find_image(message) is None:
+            return None, {"prompt": 0, "completion": 0}
+        return await engine.describe_image(message)
+    return await asyncio.gather(*[describe(message) for message in messages])
 
 ######## OpenAI Engine ########
 
@@ -90,6 +282,8 @@ class OpenAIEngine:
         except KeyError:
             logger.warning(f"Could not get encoding for model `{self.model.split('/')[-1]}`, falling back to encoding for `{self.fallback_enc_base}`")
             self.encoding = tiktoken.get_encoding(self.fallback_enc_base)
+        self.token_counter = TokenCounter(self.encoding)
+        self.prompt_cache = PromptCacheStats()
 
         logger.info('OpenAI Engine was initialized')
 
@@ -115,6 +309,9 @@ class OpenAIEngine:
 
         self.vision = self.config.getboolean("OpenAI", "Vision")
         self.function_calling = self.config.getboolean("OpenAI", "FunctionCalling") 
+        # max number of model turns with tool calls for one message and timeout of one tool call (seconds)
+        self.max_tool_depth = self.config.getint("OpenAI", "MaxToolDepth", fallback=5)
+        self.tool_timeout = self.config.getfloat("OpenAI", "ToolTimeout", fallback=60)
         if self.vision:
             self.image_size = int(self.config.get("OpenAI", "ImageSize")) 
             self.delete_image_after_chat = self.config.getboolean("OpenAI", "DeleteImageAfterAnswer") if self.config.has_option("OpenAI", "DeleteImageAfterAnswer") else False
@@ -150,11 +347,10 @@ class OpenAIEngine:
         Input:
             * response - response from GPT
         Output:
-            * response - response from GPT (None if function was not detected or there was an error)
+            * response - ('function', tool_calls, tokens, text) if functions were called, otherwise the same response
+              tool_calls - list of all calls in the response: [{"id": str, "name": str, "args": dict}, ...]
         '''
         response_message = None
-        text = None
-        tool_id = None
         try:
             logger.debug(f'Detecting function called in response: "{response}"')
             if response is None:
@@ -166,22 +362,87 @@ class OpenAIEngine:
             if len(self.function_calling_tools) == 0:
                 return response
             response_message = response.choices[0].message
-            tool_calls = response_message.tool_calls
-            if not tool_calls:
+            if not response_message.tool_calls:
                 return response
-            function_name = tool_calls[0].function.name
-            function_args = json.loads(tool_calls[0].function.arguments)
-            # tool_id = tool_calls[0].tool_id
+            tool_calls = []
+            for tool_call in response_message.tool_calls:
+                try:
+                    function_args = json.loads(tool_call.function.arguments or '{}')
+                except json.JSONDecodeError:
+                    logger.error(f'Could not parse arguments of function {tool_call.function.name}: {tool_call.function.arguments}')
+                    function_args = None
+                tool_calls.append({"id": tool_call.id, "name": tool_call.function.name, "args": function_args})
             tokens = {
                 "prompt": response.usage.prompt_tokens,
                 "completion": response.usage.completion_tokens
             }
-            return ('function', function_name, function_args, tokens, text, tool_id)
+            return ('function', tool_calls, tokens, response_message.content or None)
         except Exception as e:
             logger.error(f'Could not detect function called: {e}. Response: {response_message}')
             return response
         
-    async def chat(self, id=0, messages=None, attempt=0):
+    def record_prompt_cache(self, response) -> None:
+        '''
+        Record prompt tokens that were cached by OpenAI (automatic prefix caching)
+        '''
+        details = getattr(response.usage, 'prompt_tokens_details', None)
+        self.prompt_cache.add(int(response.usage.prompt_tokens), int(getattr(details, 'cached_tokens', 0) or 0))
+
+    def tool_call_message(self, tool_calls, text=None) -> dict:
+        '''
+        Message of assistant with tool calls (for chat history)
+        '''
+        return {
+            "role": "assistant",
+            "content": text,
+            "tool_calls": [
+                {"id": call["id"], "type": "function", "function": {"name": call["name"], "arguments": json.dumps(call["args"] or {}, ensure_ascii=False)}}
+                for call in tool_calls
+            ],
+        }
+
+    def tool_result_messages(self, results) -> list:
+        '''
+        Messages with results of tool calls (for chat history)
+        Input:
+            * results - list of (tool_call, content)
+        '''
+        return [{"role": "tool", "tool_call_id": call["id"], "content": str(content)} for call, content in results]
+
+    async def stream_response(self, on_delta, **kwargs):
+        '''
+        Get streamed response from GPT
+        Text deltas are passed to on_delta (async function) as soon as they are received,
+        returns response object with the same fields as a non-streamed response (text, tool calls, usage)
+        '''
+        stream = await self.client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+        text, tool_calls, usage = [], {}, None
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                text.append(delta.content)
+                await on_delta(delta.content)
+            for tool_call in delta.tool_calls or []:
+                call = tool_calls.setdefault(tool_call.index, {"id": None, "name": "", "arguments": ""})
+                if tool_call.id:
+                    call["id"] = tool_call.id
+                if tool_call.function is not None:
+                    call["name"] += tool_call.function.name or ""
+                    call["arguments"] += tool_call.function.arguments or ""
+        tool_calls = [
+            SimpleNamespace(id=call["id"], type="function", function=SimpleNamespace(name=call["name"], arguments=call["arguments"]))
+            for _, call in sorted(tool_calls.items())
+        ]
+        message = SimpleNamespace(role="assistant", content="".join(text), tool_calls=tool_calls or None)
+        if usage is None:
+            usage = SimpleNamespace(prompt_tokens=0, completion_tokens=0)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+    async def chat(self, id=0, messages=None, attempt=0, on_delta=None):
         '''
         Chat with GPT
         Input id of user and message
@@ -193,6 +454,7 @@ class OpenAIEngine:
                 {"role": "assistant", "content": "I am fine, how are you?"},
                 ...]
           * attempt - attempt to send message
+          * on_delta - async function that receives parts of response while it is generated (streaming, optional)
         Output:
             * response - response from GPT (just text of last reply)
             * messages - messages from GPT (all messages - list of dictionaries with last message at the end)
@@ -211,37 +473,37 @@ class OpenAIEngine:
                 return 'Your message was flagged as violating OpenAI\'s usage policy and was not sent. Please try again.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}    
         # get response from GPT
         try:
-            messages_tokens = await self.count_tokens(messages)
-            if messages_tokens is None:
-                messages_tokens = 0
-
             user_id = hashlib.sha1(str(id).encode("utf-8")).hexdigest() if self.end_user_id else None
-            # requested_tokens = min(self.max_tokens, self.max_tokens - messages_tokens)
-            # requested_tokens = max(requested_tokens, 50)
+            # images are stored as references in chat history, resolve them only for the request
+            request_messages = await get_blob_store().resolve_messages(messages) if self.vision else messages
+            # streamed responses are assembled into the same structure as non-streamed ones
+            create = functools.partial(self.stream_response, on_delta) if on_delta is not None else self.client.chat.completions.create
             if self.function_calling:
-                response = await self.client.chat.completions.create(
+                response = await create(
                         model=self.model,
                         temperature=self.temperature, 
                         # max_tokens=requested_tokens,
-                        messages=messages,
+                        messages=request_messages,
                         user=str(user_id),
                         tools=self.function_calling_tools,
                         tool_choice="auto",
                 )
+                self.record_prompt_cache(response)
                 response = await self.detect_function_called(response)
                 if response is not None:
                     if type(response) == tuple:
                         if response[0] == 'function':
-                            logger.info(f'Function {response[1]} was called by user {id}')
-                            return response, messages, response[3]
+                            logger.info(f'Functions {[call["name"] for call in response[1]]} were called by user {id}')
+                            return response, messages, response[2]
             else:
-                response = await self.client.chat.completions.create(
+                response = await create(
                         model=self.model,
                         temperature=self.temperature, 
                         # max_tokens=requested_tokens,
-                        messages=messages,
+                        messages=request_messages,
                         user=str(user_id)
                 )
+                self.record_prompt_cache(response)
 
             prompt_tokens = int(response.usage.prompt_tokens)
             completion_tokens = int(response.usage.completion_tokens)
@@ -288,6 +550,7 @@ class OpenAIEngine:
             response += '\nIt seems like you reached length limit of chat session. You can continue, but I advice you to /delete session.'
         return response, messages, {"prompt": prompt_tokens, "completion": completion_tokens}
 
+    @cached_summary
     async def summary(self, text, size=420):
         '''
         Make summary of text
@@ -325,9 +588,8 @@ class OpenAIEngine:
             text = ''
             prompt_tokens, completion_tokens = 0, 0
             # Concatenate all messages into a single string
-            for i in range(1, len(messages)):
-                message = messages[i]
-                image_description, token_usage = await self.describe_image(message)
+            descriptions = await describe_images(self, messages[1:])
+            for message, (image_description, token_usage) in zip(messages[1:], descriptions):
                 if image_description is None:
                     text += message['role'] + ': ' + str(message['content']) + '\n'
                 else:
@@ -384,9 +646,10 @@ class OpenAIEngine:
             logger.exception('Could not moderate message')
             return None
 
-    async def count_tokens(self, messages):
+    async def count_tokens(self, messages, each=False):
         '''
         Count tokens in messages via tiktoken
+        Returns total number of tokens or number of tokens in every message (each=True)
         '''
         try:
             # If messages empty
@@ -394,15 +657,14 @@ class OpenAIEngine:
                 logger.debug('Messages are empty')
                 return None
             if len(messages) == 0:
-                return 0
+                return [] if each else 0
+            # Check if there is images in messages and leave only text
+            if self.vision:
+                messages = [(await self.leave_only_text(message))[0] for message in messages]
             # Count the number of tokens
-            tokens = 0
-            for message in messages:
-                # Check if there is images in message and leave only text
-                if self.vision:
-                    message, trimmed = await self.leave_only_text(message)
-                text = f"{message['role']}: {message['content']}"
-                tokens += len(self.encoding.encode(text))
+            if each:
+                return await self.token_counter.count_messages(messages)
+            tokens = await self.token_counter.count(messages)
             logger.debug(f'Messages were counted for tokens: {tokens}')
             return tokens
         except Exception as e:
@@ -431,6 +693,7 @@ class OpenAIEngine:
             logger.exception('Could not leave only text in message')
             return message, False
         
+    @cached_image_description
     async def describe_image(self, message, user_id=None):
         '''
         Describe image that was sent by user
@@ -461,7 +724,7 @@ class OpenAIEngine:
                         },
                         {
                             "type": "image_url",
-                            "image_url": image_url
+                            "image_url": await get_blob_store().resolve_url(image_url)
                         }
                     ]
                 }
@@ -493,16 +756,20 @@ class OpenAIEngine:
             return None
         try:
             tokens_prompt, tokens_completion = 0, 0
+            # Leave only text in messages
+            texts = [await self.leave_only_text(message) for message in messages]
+            # images of messages that are changed are described concurrently
+            if self.image_description:
+                descriptions = await describe_images(self, [message if trimmed else {} for message, (_, trimmed) in zip(messages, texts)])
             # Check if there is images in messages
             for i in range(len(messages)):
-                # Leave only text in message
-                text, trimmed = await self.leave_only_text(messages[i])
+                text, trimmed = texts[i]
                 if trimmed == False:
                     # no images in message
                     continue
                 text = text['content'] 
                 if self.image_description:
-                    image_description, token_usage = await self.describe_image(messages[i])
+                    image_description, token_usage = descriptions[i]
                     tokens_prompt += int(token_usage['prompt'])
                     tokens_completion += int(token_usage['completion'])
                     text += f'\n<There was an image here, but it was deleted. Image description: {image_description} Resend the image if you needed.>'
@@ -524,10 +791,13 @@ class YandexEngine:
         Initialize Yandex API for text generation
         Available: text generation
         '''
-        import requests 
+        import aiohttp
         import json
-        self.requests = requests
+        from chatutils.http_session import get_http_client
+        self.aiohttp = aiohttp
         self.json = json
+        # shared async client with connection pool, does not block the event loop
+        self.http = get_http_client()
         self.text_initiation, self.speech_initiation = text, speech
         self.text_init() if self.text_initiation else None
         self.speech_init() if self.speech_initiation else None
@@ -545,6 +815,8 @@ class YandexEngine:
         self.fallback_enc_base = 'cl100k_base'
         logger.info(f"Loading encoding for `{self.fallback_enc_base}` for estimating token usage")
         self.encoding = tiktoken.get_encoding(self.fallback_enc_base)
+        self.token_counter = TokenCounter(self.encoding)
+        self.prompt_cache = PromptCacheStats()
         
         logger.info('Yandex Engine was initialized')
 
@@ -579,6 +851,7 @@ class YandexEngine:
         self.chat_vars['Endpoint'] = self.config.get("YandexGPT", "Endpoint")
         self.chat_vars['Model'] = self.config.get("YandexGPT", "ChatModel")
         self.chat_vars['SummarisationModel'] = self.config.get("YandexGPT", "SummarisationModel")
+        self.summary_model = self.chat_vars['SummarisationModel']
         self.chat_vars['Temperature'] = self.config.getfloat("YandexGPT", "Temperature")
         self.chat_vars['MaxTokens'] = self.config.getint("YandexGPT", "MaxTokens")
         self.chat_vars['SystemMessage'] = self.config.get("YandexGPT", "SystemMessage")
@@ -631,7 +904,7 @@ class YandexEngine:
         # TODO: implement speech to text with Yandex API
         pass
 
-    async def chat(self, id=0, messages=None, attempt=0):
+    async def chat(self, id=0, messages=None, attempt=0, on_delta=None):
         '''
         Chat with Yandex GPT
         Input id of user and message
@@ -643,6 +916,7 @@ class YandexEngine:
                 {"role": "assistant", "content": "I am fine, how are you?"},
                 ...]
           * attempt - attempt to send message
+          * on_delta - async function that receives parts of response while it is generated (streaming, optional)
         Output:
             * response - response from Yandex GPT (just text of last reply)
             * messages - messages from Yandex GPT (all messages - list of dictionaries with last message at the end)
@@ -669,13 +943,24 @@ class YandexEngine:
             payload = {
                 "modelUri": self.chat_vars['Model'],
                 "completionOptions": {
-                    "stream": False,
+                    "stream": on_delta is not None,
                     "temperature": self.chat_vars['Temperature'],
                     "maxTokens": requested_tokens,
                 },
                 "messages": new_messages
             }
-            response = self.requests.post(self.chat_vars['Endpoint'], json=payload, headers=self.headers)
+            if on_delta is not None:
+                # streamed response is a sequence of JSON lines with the whole text generated so far,
+                # the last line (with usage) is returned as response text
+                streamed = {"text": ""}
+                async def on_line(line):
+                    text = self.json.loads(line)['result']['alternatives'][0]['message']['text']
+                    if len(text) > len(streamed["text"]):
+                        await on_delta(text[len(streamed["text"]):])
+                        streamed["text"] = text
+                response = await self.http.post(self.chat_vars['Endpoint'], json=payload, headers=self.headers, on_line=on_line)
+            else:
+                response = await self.http.post(self.chat_vars['Endpoint'], json=payload, headers=self.headers)
             
             if response.status_code == 200:
                 logger.debug(f'Yandex GPT response: {response.text}')
@@ -707,8 +992,8 @@ class YandexEngine:
             else:
                 logger.error(f'Yandex GPT Error: {response.text} (code: {response.status_code})')
                 return "Something went wrong with Yandex GPT. Please try again later.", messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
-        except self.requests.exceptions.ConnectionError as e:
-            logger.error(f'Connection error to Yandex API: {e}')
+        except (self.aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            logger.error(f'Connection error to Yandex API: {e!r}')
             return 'Yandex API service is not available. Please try again later.', messages[:-1], {"prompt": prompt_tokens, "completion": completion_tokens}
         except Exception as e:
             logger.error(f'Something went wrong with attempt to get response from Yandex GPT: {e}')
@@ -742,6 +1027,7 @@ class YandexEngine:
             logger.exception('Could not revise messages for Yandex API')
             raise Exception('Could not revise messages for YandexGPT API')
 
+    @cached_summary
     async def summary(self, text, size=420):
         '''
         Make summary of text
@@ -764,7 +1050,7 @@ class YandexEngine:
                 ]
             }
             
-            response = self.requests.post(self.chat_vars['Endpoint'], json=payload, headers=self.headers)
+            response = await self.http.post(self.chat_vars['Endpoint'], json=payload, headers=self.headers)
             
             if response.status_code == 200:
                 logger.debug(f'Yandex GPT response: {response.text}')
@@ -804,9 +1090,10 @@ class YandexEngine:
             logger.exception('Could not summarize chat history')
             return None
     
-    async def count_tokens(self, messages):
+    async def count_tokens(self, messages, each=False):
         '''
         Count tokens in messages via tiktoken
+        Returns total number of tokens or number of tokens in every message (each=True)
         '''
         try:
             # If messages empty
@@ -814,15 +1101,14 @@ class YandexEngine:
                 logger.debug('Messages are empty')
                 return None
             if len(messages) == 0:
-                return 0
+                return [] if each else 0
+            # Check if there is images in messages and leave only text
+            if self.vision:
+                messages = [(await self.leave_only_text(message))[0] for message in messages]
             # Count the number of tokens
-            tokens = 0
-            for message in messages:
-                # Check if there is images in message and leave only text
-                if self.vision:
-                    message, trimmed = await self.leave_only_text(message)
-                text = f"{message['role']}: {message['content']}"
-                tokens += len(self.encoding.encode(text))
+            if each:
+                return await self.token_counter.count_messages(messages)
+            tokens = await self.token_counter.count(messages)
             logger.debug(f'Messages were counted for tokens: {tokens}')
             return tokens
         except Exception as e:
@@ -885,6 +1171,8 @@ class AnthropicEngine:
         self.fallback_enc_base = 'cl100k_base'
         logger.info(f"Loading encoding for `{self.fallback_enc_base}` for estimating token usage")
         self.encoding = tiktoken.get_encoding(self.fallback_enc_base)
+        self.token_counter = TokenCounter(self.encoding)
+        self.prompt_cache = PromptCacheStats()
 
         logger.info('Anthropic Engine was initialized')
 
@@ -906,9 +1194,17 @@ class AnthropicEngine:
         self.summarize_too_long = self.config.getboolean("Anthropic", "SummarizeTooLong") 
         self.model_completion_price = float(self.config.get("Anthropic", "ChatModelCompletionPrice")) 
         self.model_prompt_price = float(self.config.get("Anthropic", "ChatModelPromptPrice")) 
+        # prompt caching: stable prefix of request (system prompt, tools, history) is cached by Anthropic,
+        # cache writes cost more and cache reads cost much less than usual prompt tokens
+        self.prompt_caching = self.config.getboolean("Anthropic", "PromptCaching", fallback=True)
+        self.model_cache_write_price = self.config.getfloat("Anthropic", "ChatModelCacheWritePrice", fallback=self.model_prompt_price * 1.25)
+        self.model_cache_read_price = self.config.getfloat("Anthropic", "ChatModelCacheReadPrice", fallback=self.model_prompt_price * 0.1)
 
         self.vision = self.config.getboolean("Anthropic", "Vision")
         self.function_calling = self.config.getboolean("Anthropic", "FunctionCalling") 
+        # max number of model turns with tool calls for one message and timeout of one tool call (seconds)
+        self.max_tool_depth = self.config.getint("Anthropic", "MaxToolDepth", fallback=5)
+        self.tool_timeout = self.config.getfloat("Anthropic", "ToolTimeout", fallback=60)
         if self.vision:
             self.image_size = int(self.config.get("Anthropic", "ImageSize")) 
             self.delete_image_after_chat = self.config.getboolean("Anthropic", "DeleteImageAfterAnswer") if self.config.has_option("Anthropic", "DeleteImageAfterAnswer") else False
@@ -967,12 +1263,13 @@ class AnthropicEngine:
                     for i in range(len(current_content)):
                         if 'type' in current_content[i]:
                             if current_content[i]['type'] == 'image_url':
+                                media_type, data = await get_blob_store().resolve_image(current_content[i]['image_url'])
                                 tmp.append({
                                     "type": "image",
                                     "source": {
                                         "type": "base64",
-                                        "media_type": current_content[i]['image_url']['url'].split(';base64,')[0].split(':')[1],
-                                        "data": current_content[i]['image_url']['url'].split(';base64,')[1]
+                                        "media_type": media_type,
+                                        "data": data
                                     }
                                 })
                             else:
@@ -1002,13 +1299,10 @@ class AnthropicEngine:
         Input:
             * response - response from Anthropic API
         Output:
-            * response - revised response if function was called, otherwise the same response
+            * response - ('function', tool_calls, tokens, text) if functions were called, otherwise the same response
+              tool_calls - list of all calls in the response: [{"id": str, "name": str, "args": dict}, ...]
         '''
         response_message = None
-        function_name = None
-        function_args = None
-        text = None
-        tool_id = None
         try:
             logger.debug(f'Detecting function called in response: "{response}"')
             if response is None:
@@ -1023,24 +1317,94 @@ class AnthropicEngine:
             text = None
             if response.stop_reason == 'tool_use':
                 logger.debug(f'Function was called in response')
+                tool_calls = []
                 for content in response.content:
                     if type(content) == self.anthropic.types.TextBlock:
                         text = content.text
                     if type(content) == self.anthropic.types.ToolUseBlock:
-                        function_name = content.name
-                        function_args = content.input
-                        tool_id = content.id
-                tokens = {
-                    "prompt": response.usage.input_tokens,
-                    "completion": response.usage.output_tokens
-                }
-                return ('function', function_name, function_args, tokens, text, tool_id)
+                        tool_calls.append({"id": content.id, "name": content.name, "args": content.input})
+                return ('function', tool_calls, self.usage(response), text)
             return response
         except Exception as e:
             logger.error(f'Could not detect function called: {e}. Response: {response_message}')
             return response
 
-    async def chat(self, id=0, messages=None, attempt=0):
+    def cache_request(self, system_prompt, messages, tools=None):
+        '''
+        Mark stable prefix of request for prompt caching: system prompt, tools and the last messages
+        (rolling breakpoint, the next request reads the prefix cached by this one)
+        https://docs.anthropic.com/en/docs/build-with-claude/prompt-caching
+        Only changed blocks are copied, chat history is not changed
+        Output:
+            * system_prompt, messages, tools - revised request parts
+        '''
+        cache_control = {"type": "ephemeral"}
+        if system_prompt:
+            system_prompt = [{"type": "text", "text": system_prompt, "cache_control": cache_control}]
+        if tools:
+            tools = tools[:-1] + [dict(tools[-1], cache_control=cache_control)]
+        # last message and the last user message before it (at most 4 breakpoints per request)
+        messages = list(messages)
+        marked = 0
+        for i in range(len(messages) - 1, -1, -1):
+            if marked == 2:
+                break
+            if marked == 1 and messages[i]['role'] != 'user':
+                continue
+            content = messages[i]['content']
+            if type(content) != list or not content:
+                continue
+            messages[i] = dict(messages[i], content=content[:-1] + [dict(content[-1], cache_control=cache_control)])
+            marked += 1
+        return system_prompt, messages, tools
+
+    def usage(self, response) -> dict:
+        '''
+        Token usage of response (with tokens written to and read from prompt cache)
+        '''
+        return {
+            "prompt": int(response.usage.input_tokens),
+            "completion": int(response.usage.output_tokens),
+            "cache_write": int(getattr(response.usage, 'cache_creation_input_tokens', 0) or 0),
+            "cache_read": int(getattr(response.usage, 'cache_read_input_tokens', 0) or 0),
+        }
+
+    def record_prompt_cache(self, response) -> None:
+        '''
+        Record prompt tokens that were read from prompt cache (input_tokens do not include cached tokens)
+        '''
+        usage = self.usage(response)
+        self.prompt_cache.add(usage['prompt'] + usage['cache_write'] + usage['cache_read'], usage['cache_read'])
+
+    def tool_call_message(self, tool_calls, text=None) -> dict:
+        '''
+        Message of assistant with tool calls (for chat history)
+        https://docs.anthropic.com/claude/docs/tool-use-examples
+        '''
+        content = [{"type": "text", "text": text}] if text else []
+        content.extend({"type": "tool_use", "id": call["id"], "name": call["name"], "input": call["args"] or {}} for call in tool_calls)
+        return {"role": "assistant", "content": content}
+
+    def tool_result_messages(self, results) -> list:
+        '''
+        Messages with results of tool calls (for chat history), all results are sent in one user message
+        Input:
+            * results - list of (tool_call, content)
+        '''
+        return [{"role": "user", "content": [{"type": "tool_result", "tool_use_id": call["id"], "content": str(content)} for call, content in results]}]
+
+    async def stream_response(self, on_delta, **kwargs):
+        '''
+        Get streamed response from Claude
+        Text deltas are passed to on_delta (async function) as soon as they are received,
+        returns the final message (the same as a non-streamed response)
+        '''
+        async with self.client.messages.stream(**kwargs) as stream:
+            async for text in stream.text_stream:
+                await on_delta(text)
+            return await stream.get_final_message()
+
+    async def chat(self, id=0, messages=None, attempt=0, on_delta=None):
         '''
         Chat with Claude
         Input id of user and message
@@ -1052,6 +1416,7 @@ class AnthropicEngine:
                 {"role": "assistant", "content": "I am fine, how are you?"},
                 ...]
           * attempt - attempt to send message
+          * on_delta - async function that receives parts of response while it is generated (streaming, optional)
         Output:
             * response - response from Claude (just text of last reply)
             * messages - messages from Claude (all messages - list of dictionaries with last message at the end)
@@ -1074,31 +1439,38 @@ class AnthropicEngine:
             requested_tokens = min(self.max_tokens, self.max_tokens - messages_tokens)
             requested_tokens = max(requested_tokens, 50)
             system_prompt, new_messages = await self.revise_messages(messages)
+            tools = self.function_calling_tools if self.function_calling else None
+            if self.prompt_caching:
+                system_prompt, new_messages, tools = self.cache_request(system_prompt, new_messages, tools)
+            create = functools.partial(self.stream_response, on_delta) if on_delta is not None else self.client.messages.create
             if self.function_calling:
-                response = await self.client.messages.create(
+                response = await create(
                         model=self.model,
                         temperature=self.temperature, 
                         max_tokens=requested_tokens,
                         system=system_prompt,
                         messages=new_messages,
-                        tools=self.function_calling_tools,
+                        tools=tools,
                 )
+                self.record_prompt_cache(response)
                 response = await self.detect_function_called(response)
                 if response is not None:
                     if type(response) == tuple:
                         if response[0] == 'function':
-                            logger.info(f'Function {response[1]} was called by user {id}')
-                            return response, messages, response[3]
+                            logger.info(f'Functions {[call["name"] for call in response[1]]} were called by user {id}')
+                            return response, messages, response[2]
             else:
-                response = await self.client.messages.create(
+                response = await create(
                         model=self.model,
                         temperature=self.temperature, 
                         max_tokens=requested_tokens,
                         system=system_prompt,
                         messages=new_messages
                 )
-            prompt_tokens = int(response.usage.input_tokens)
-            completion_tokens = int(response.usage.output_tokens)
+                self.record_prompt_cache(response)
+            usage = self.usage(response)
+            prompt_tokens, completion_tokens = usage['prompt'], usage['completion']
+            logger.debug(f'Token usage: {usage}')
             # Delete images from chat history
             if self.vision and self.delete_image_after_chat:
                 messages, token_usage = await self.delete_images(messages)
@@ -1142,8 +1514,9 @@ class AnthropicEngine:
         if attempt == 1:
             # if chat is too long, return response and advice to delete session
             response += '\nIt seems like you reached length limit of chat session. You can continue, but I advice you to /delete session.'
-        return response, messages, {"prompt": prompt_tokens, "completion": completion_tokens}
+        return response, messages, {"prompt": prompt_tokens, "completion": completion_tokens, "cache_write": usage['cache_write'], "cache_read": usage['cache_read']}
 
+    @cached_summary
     async def summary(self, text, size=400):
         '''
         Make summary of text
@@ -1179,9 +1552,8 @@ class AnthropicEngine:
             text = ''
             prompt_tokens, completion_tokens = 0, 0
             # Concatenate all messages into a single string
-            for i in range(1, len(messages)):
-                message = messages[i]
-                image_description, token_usage = await self.describe_image(message)
+            descriptions = await describe_images(self, messages[1:])
+            for message, (image_description, token_usage) in zip(messages[1:], descriptions):
                 if image_description is None:
                     text += message['role'] + ': ' + str(message['content']) + '\n'
                 else:
@@ -1203,9 +1575,10 @@ class AnthropicEngine:
             logger.exception('Could not summarize chat history')
             return None, {"prompt": 0, "completion": 0}
 
-    async def count_tokens(self, messages):
+    async def count_tokens(self, messages, each=False):
         '''
         Count tokens in messages via tiktoken
+        Returns total number of tokens or number of tokens in every message (each=True)
         '''
         try:
             # If messages empty
@@ -1213,15 +1586,14 @@ class AnthropicEngine:
                 logger.debug('Messages are empty')
                 return None
             if len(messages) == 0:
-                return 0
+                return [] if each else 0
+            # Check if there is images in messages and leave only text
+            if self.vision:
+                messages = [(await self.leave_only_text(message))[0] for message in messages]
             # Count the number of tokens
-            tokens = 0
-            for message in messages:
-                # Check if there is images in message and leave only text
-                if self.vision:
-                    message, trimmed = await self.leave_only_text(message)
-                text = f"{message['role']}: {message['content']}"
-                tokens += len(self.encoding.encode(text))
+            if each:
+                return await self.token_counter.count_messages(messages)
+            tokens = await self.token_counter.count(messages)
             logger.debug(f'Messages were counted for tokens: {tokens}')
             return tokens
         except Exception as e:
@@ -1250,6 +1622,7 @@ class AnthropicEngine:
             logger.exception('Could not leave only text in message')
             return message, False
         
+    @cached_image_description
     async def describe_image(self, message, user_id=None):
         '''
         Describe image that was sent by user
@@ -1272,6 +1645,7 @@ class AnthropicEngine:
                         break
                 if success == False:
                     return None, {"prompt": 0, "completion": 0}
+                media_type, data = await get_blob_store().resolve_image(image_url)
                 new_message = {
                     "role": 'user',
                     "content": [{
@@ -1282,8 +1656,8 @@ class AnthropicEngine:
                             "type": "image",
                             "source": {
                                 "type": "base64",
-                                "media_type": "image/jpeg",
-                                "data": image_url,
+                                "media_type": media_type,
+                                "data": data,
                             },
                         }
                     ]
@@ -1315,16 +1689,20 @@ class AnthropicEngine:
             return None
         try:
             tokens_prompt, tokens_completion = 0, 0
+            # Leave only text in messages
+            texts = [await self.leave_only_text(message) for message in messages]
+            # images of messages that are changed are described concurrently
+            if self.image_description:
+                descriptions = await describe_images(self, [message if trimmed else {} for message, (_, trimmed) in zip(messages, texts)])
             # Check if there is images in messages
             for i in range(len(messages)):
-                # Leave only text in message
-                text, trimmed = await self.leave_only_text(messages[i])
+                text, trimmed = texts[i]
                 if trimmed == False:
                     # no images in message
                     continue
                 text = text['content'] 
                 if self.image_description:
-                    image_description, token_usage = await self.describe_image(messages[i])
+                    image_description, token_usage = descriptions[i]
                     tokens_prompt += int(token_usage['prompt'])
                     tokens_completion += int(token_usage['completion'])
                     text += f'\n<There was an image here, but it was deleted. Image description: {image_description} Resend the image if you needed.>'
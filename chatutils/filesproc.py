@@ -236,6 +236,9 @@ class FilesRAG:
             os.makedirs(self.path, exist_ok=True)
 
         self.emb_engine = get_embeddings_engine()
+        # collection uses squared L2 distance (for normalized embeddings it is 2 - 2 * cosine similarity),
+        # good cutoff depends on embeddings model, so there is no cutoff by default
+        self.max_distance = config.getfloat("Files", "MaxDistance", fallback=None)
         
         self.client = chromadb.PersistentClient(
             path=chromadb_path,
@@ -296,77 +299,67 @@ class FilesRAG:
             logger.error(f"Error inserting texts: {e}")
             return False
 
-    async def search_text(self, text, user_id, n_results=4, filter: dict = None, max_distance=1.0) -> list:
+    @staticmethod
+    def owners_where(*owners) -> dict:
+        """
+        Metadata filter for chunks of the given owners (user ids and/or "common").
+
+        User ids are stored as strings, so all owners fit into one `$in` condition.
+        Chunks stored earlier with integer user ids are matched too.
+        """
+        where = {"user_id": {"$in": [str(owner) for owner in owners]}}
+        legacy = [owner for owner in owners if not isinstance(owner, str)]
+        if legacy:
+            where = {"$or": [where, {"user_id": {"$in": legacy}}]}
+        return where
+
+    async def search_text(self, text, user_id, n_results=4, filter: dict = None, max_distance=None) -> dict:
         """
         Searches for similar texts based on the given vector. Embeddings are calculated for the text using the embeddings engine.
+        Texts of the user and common texts are searched with a single query.
 
         Parameters:
             text: text to search for
             user_id: user id to filter results (also searches for user_id = 'common')
-            n_results: number of results to return
+            n_results: number of results to return (over user and common texts)
             filter: dictionary with filter conditions
-            max_distance: maximum distance for search
+            max_distance: maximum distance for search, results that are further are dropped (Files.MaxDistance by default, no cutoff if not set)
         
-        Returns a list of results.
+        Returns results in the format of the collection query (one row, sorted by distance):
+            {"ids": [[...]], "documents": [[...]], "metadatas": [[...]], "distances": [[...]]}
         """
         try:
             vector, _ = await self.emb_engine.get_embeddings(text)
+            if max_distance is None:
+                max_distance = self.max_distance
 
-            where_clause = filter.copy() if filter else {}
-
-            # Query for user-specific content
-            where_clause["user_id"] = user_id
-            result_user = self.collection.query(
-                query_embeddings=[vector],
-                n_results=n_results,
-                where=where_clause
-            )
+            where_clause = self.owners_where(user_id, "common")
+            if filter:
+                where_clause = {"$and": [{key: value} for key, value in filter.items()] + [where_clause]}
 
-            # Query for common content
-            where_clause["user_id"] = "common"
-            result_common = self.collection.query(
+            result = self.collection.query(
                 query_embeddings=[vector],
                 n_results=n_results,
-                where=where_clause
+                where=where_clause,
+                include=["documents", "metadatas", "distances"]
             )
 
-            # Initialize with the user results
-            result = {}
-            
-            # Function to safely initialize or extend lists
-            def init_or_extend(target_dict, key, source_dict):
-                if key in source_dict and source_dict[key] and len(source_dict[key]) > 0:
-                    if key not in target_dict or not target_dict[key]:
-                        target_dict[key] = source_dict[key]
-                    else:
-                        target_dict[key].extend(source_dict[key])
-
-            # Process user results
-            if result_user and all(key in result_user for key in ["ids", "embeddings", "documents", "metadatas", "distances"]):
-                for key in ["ids", "embeddings", "documents", "metadatas", "distances"]:
-                    init_or_extend(result, key, result_user)
-
-            # Process common results
-            if result_common and all(key in result_common for key in ["ids", "embeddings", "documents", "metadatas", "distances"]):
-                for key in ["ids", "embeddings", "documents", "metadatas", "distances"]:
-                    init_or_extend(result, key, result_common)
-
-            if not result or "ids" not in result or not result["ids"]:
+            # results are sorted by distance already, so cutoff keeps top results
+            hits = [
+                hit for hit in zip(result["ids"][0], result["documents"][0], result["metadatas"][0], result["distances"][0])
+                if max_distance is None or hit[3] <= max_distance
+            ]
+            if not hits:
                 logger.info("No results found for the given search.")
-                return []
-            
-            # Sort results based on distance
-            if all(key in result for key in ["ids", "embeddings", "documents", "metadatas", "distances"]):
-                # Create a list of tuples for sorting
-                combined = list(zip(result["ids"], result["embeddings"], result["documents"], 
-                                  result["metadatas"], result["distances"]))
-                # Sort by distance (5th element, index 4)
-                combined.sort(key=lambda x: x[4])
-                
-                # Unpack the sorted results
-                result["ids"], result["embeddings"], result["documents"], result["metadatas"], result["distances"] = \
-                    [list(item) for item in zip(*combined)]
+                return {}
 
+            ids, documents, metadatas, distances = zip(*hits)
+            result = {
+                "ids": [list(ids)],
+                "documents": [list(documents)],
+                "metadatas": [list(metadatas)],
+                "distances": [list(distances)],
+            }
             logger.debug(f"Search results: {result}")
             return result
         except KeyboardInterrupt:
@@ -376,7 +369,7 @@ class FilesRAG:
             logger.error(f"Error searching texts: {e}")
             return None
         
-    async def semantic_search(self, text, user_id, n_results=4, filter: dict = None, max_distance=1.0) -> list:
+    async def semantic_search(self, text, user_id, n_results=4, filter: dict = None, max_distance=None) -> list:
         """
         Searches for similar texts based on the given text. Embeddings are calculated for the text using the embeddings engine.
 
@@ -385,7 +378,7 @@ class FilesRAG:
             user_id: user id to filter results
             n_results: number of results to return
             filter: dictionary with filter conditions
-            max_distance: maximum distance for search
+            max_distance: maximum distance for search (see search_text)
 
         Returns a list of results - formatted to {"filename": [text, ...]}
         Uses search_text to get the results and then formats them based on the filename.
@@ -397,12 +390,9 @@ class FilesRAG:
             results = await self.search_text(text, user_id, n_results, filter, max_distance)
             if results:
                 formatted_results = {}
-                for i, result in enumerate(results["metadatas"]):
-                    if result and "filename" in result[0]:
-                        filename = result[0]["filename"]
-                        if filename not in formatted_results:
-                            formatted_results[filename] = []
-                        formatted_results[filename].extend(results["documents"][i])  
+                for metadata, document in zip(results["metadatas"][0], results["documents"][0]):
+                    if metadata and "filename" in metadata:
+                        formatted_results.setdefault(metadata["filename"], []).append(document)
                 logger.debug(f"Semantic search results: {formatted_results}")
                 return formatted_results
             else:
@@ -441,7 +431,7 @@ class FilesRAG:
         Returns True if texts were successfully removed, False otherwise.
         """
         try:
-            self.collection.delete(where={"user_id": user_id})
+            self.collection.delete(where=self.owners_where(user_id))
             logger.info("Texts removed successfully.")
             return True
         except Exception as e:
@@ -460,7 +450,7 @@ class FilesRAG:
         try:
             # Use the get method instead of query to retrieve entries by metadata
             results = self.collection.get(
-                where={"user_id": user_id},
+                where=self.owners_where(user_id),
                 include=["metadatas"]
             )
             
@@ -525,7 +515,7 @@ class FilesRAG:
                     chunks.append(current_chunk)
                     chunk_end = current_start + len(current_chunk)
                     metadata.append({
-                        "user_id": user_id,
+                        "user_id": str(user_id),
                         "filename": filename,
                         "chunk_number": chunk_number,
                         "start_char": current_start,
@@ -566,7 +556,7 @@ class FilesRAG:
                         chunks.append(current_chunk)
                         chunk_end = current_start + len(current_chunk)
                         metadata.append({
-                            "user_id": user_id,
+                            "user_id": str(user_id),
                             "filename": filename,
                             "chunk_number": chunk_number,
                             "start_char": current_start,
@@ -584,7 +574,7 @@ class FilesRAG:
                             chunks.append(para_chunk)
                             chunk_end = current_start + len(para_chunk)
                             metadata.append({
-                                "user_id": user_id,
+                                "user_id": str(user_id),
                                 "filename": filename,
                                 "chunk_number": chunk_number,
                                 "start_char": current_start,
@@ -633,7 +623,7 @@ class FilesRAG:
                 chunks.append(current_chunk)
                 chunk_end = current_start + len(current_chunk)
                 metadata.append({
-                    "user_id": user_id,
+                    "user_id": str(user_id),
                     "filename": filename,
                     "chunk_number": chunk_number,
                     "start_char": current_start,
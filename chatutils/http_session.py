@@ -0,0 +1,135 @@
+# Description: Shared async HTTP client with connection pooling for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-HTTP")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import json
+import asyncio
+import aiohttp
+
+
+class HTTPResponse:
+    '''
+    Response with the body already read (connection is returned to the pool right away)
+    '''
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class HTTPClient:
+    '''
+    Async HTTP client on top of a shared aiohttp session
+        * keep-alive connection pool (limit, limit_per_host, keepalive_timeout)
+        * DNS cache (ttl_dns_cache)
+        * total and connect timeouts
+        * cap on concurrent requests (semaphore)
+    Session is created on the first request in the running event loop and closed with close()
+    '''
+    def __init__(self, limit=100, limit_per_host=20, keepalive_timeout=30, ttl_dns_cache=300,
+                 timeout=120, connect_timeout=10, max_concurrent=20):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.max_concurrent = max_concurrent
+        self.session = None
+        self.semaphore = None
+        self.loop = None
+
+    def get_session(self):
+        '''
+        Get session of the running event loop (created on the first call)
+        '''
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.ttl_dns_cache,
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+            self.loop = loop
+            logger.debug(f'HTTP session was created (limit: {self.limit}, per host: {self.limit_per_host}, concurrent requests: {self.max_concurrent})')
+        return self.session
+
+    async def request(self, method, url, on_line=None, **kwargs) -> HTTPResponse:
+        '''
+        Send request and read the whole response
+        If on_line (async function) is set, successful response is read line by line (streaming):
+        every non-empty line is passed to on_line and the last one is returned as response text
+        Raises aiohttp.ClientError on connection errors and asyncio.TimeoutError on timeouts
+        '''
+        session = self.get_session()
+        async with self.semaphore:
+            async with session.request(method, url, **kwargs) as response:
+                if on_line is not None and response.status == 200:
+                    text = ''
+                    async for line in response.content:
+                        line = line.decode('utf-8').strip()
+                        if line:
+                            await on_line(line)
+                            text = line
+                    return HTTPResponse(response.status, text, response.headers)
+                text = await response.text()
+                return HTTPResponse(response.status, text, response.headers)
+
+    async def post(self, url, **kwargs) -> HTTPResponse:
+        return await self.request('POST', url, **kwargs)
+
+    async def get(self, url, **kwargs) -> HTTPResponse:
+        return await self.request('GET', url, **kwargs)
+
+    async def close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+http_client = None
+
+def get_http_client():
+    '''
+    Get shared HTTP client for API engines (settings can be set in [HTTP] section)
+    '''
+    global http_client
+    if http_client is None:
+        http_client = HTTPClient(
+            limit=config.getint("HTTP", "MaxConnections", fallback=100),
+            limit_per_host=config.getint("HTTP", "MaxConnectionsPerHost", fallback=20),
+            timeout=config.getfloat("HTTP", "Timeout", fallback=120),
+            connect_timeout=config.getfloat("HTTP", "ConnectTimeout", fallback=10),
+            max_concurrent=config.getint("HTTP", "MaxConcurrentRequests", fallback=20),
+        )
+    return http_client
+
+async def close_http_client() -> None:
+    '''
+    Close shared HTTP client (on shutdown)
+    '''
+    if http_client is not None:
+        await http_client.close()
+
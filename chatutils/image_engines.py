@@ -243,8 +243,11 @@ class StabilityEngine:
         '''
         from random import randint
         self.randint = randint
-        import requests
-        self.requests = requests
+        import aiohttp
+        self.aiohttp = aiohttp
+        from chatutils.http_session import get_http_client
+        # shared async client with connection pool, does not block the event loop
+        self.http = get_http_client()
         import configparser
         self.config = configparser.ConfigParser({
             "ImageGenURL": "https://api.stability.ai/v2beta/stable-image/generate/core",
@@ -373,13 +376,15 @@ class StabilityEngine:
             data["prompt"] = prompt
             data["output_format"] = output_format
 
-            response = self.requests.post(
+            # multipart/form-data request
+            form = self.aiohttp.FormData()
+            for key, value in data.items():
+                form.add_field(key, str(value))
+            form.add_field("none", b'', filename="none")
+            response = await self.http.post(
                 self.settings["ImageGenURL"],
                 headers=self.headers,
-                files={
-                    "none": ''
-                },
-                data=data,
+                data=form,
             )
 
             if response.status_code == 200:
@@ -395,7 +400,7 @@ class StabilityEngine:
                     return None, f'Could not generate image. Please try again.'
             elif response.status_code == 400:
                 logger.error(f'Stability BadRequestError: {response.text}')
-                logger.debug(f'Stability request data: {response.request.body}')
+                logger.debug(f'Stability request data: {data}')
                 return None, 'Your request was rejected for some reason. Please try later or contact support.'
             elif response.status_code == 403:
                 logger.error(f'Stability ContentModerationError: {response.text}')
@@ -471,8 +476,11 @@ class YandexEngine:
         '''
         from random import randint
         self.randint = randint
-        import requests
-        self.requests = requests
+        import aiohttp
+        self.aiohttp = aiohttp
+        from chatutils.http_session import get_http_client
+        # shared async client with connection pool, does not block the event loop
+        self.http = get_http_client()
         import configparser
         self.config = configparser.ConfigParser({
             "ImageGenModel": "yandex-art/latest",
@@ -483,6 +491,7 @@ class YandexEngine:
             "ImageRateLimitTime": 0,
             "Seed": 0,
             "RequestLogging": False,
+            "ImageGenerationTimeout": 60,
         })
         self.config.read('./data/.config', encoding='utf-8')
         self.settings = self.load_image_generation_settings()
@@ -526,6 +535,7 @@ class YandexEngine:
             settings["ImageRateLimitTime"] = int(self.config.get("ImageGeneration", "ImageRateLimitTime"))
             settings["Seed"] = int(self.config.get("ImageGeneration", "Seed"))
             settings["RequestLogging"] = self.config.getboolean("ImageGeneration", "RequestLogging") 
+            settings["ImageGenerationTimeout"] = float(self.config.get("ImageGeneration", "ImageGenerationTimeout"))
             settings["CatalogID"] = self.config.get("ImageGeneration", "CatalogID")
             settings["ImageGenModel"] = self.config.get("ImageGeneration", "ImageGenModel")
             settings["ImageGenerationStyle"] = "standard" # not supported by Yandex ART
@@ -536,40 +546,43 @@ class YandexEngine:
             logger.error(f'Could not load image generation settings due: {e}')
             return None
 
-    async def check_image_generation(self, operation_id, delay=3, iterations=10):
+    async def check_image_generation(self, operation_id, delay=0.5, max_delay=5, factor=1.5, deadline=None):
         '''
-        Generation takes some time, so we need to check if image was generated every <delay> seconds
+        Generation takes some time, so we need to check if image was generated
+        Checks start fast and the delay between them grows (adaptive backoff)
         Input:
             * operation_id - id of operation
-            * delay - delay between checks
-            * iterations - number of iterations to check - if image is not generated after that, return None
-        '''
-        check_generation = True
+            * delay - delay before the first check (seconds)
+            * max_delay - maximum delay between checks (seconds)
+            * factor - delay is multiplied by factor after every check
+            * deadline - overall time limit (seconds), if image is not generated by then, return None
+        '''
+        if deadline is None:
+            deadline = self.settings["ImageGenerationTimeout"]
+        loop = asyncio.get_running_loop()
+        finish = loop.time() + deadline
         i = 0
-        while check_generation:
-            response = self.requests.get(
+        while True:
+            await asyncio.sleep(min(delay, max(finish - loop.time(), 0)))
+            i += 1
+            response = await self.http.get(
                 f'{self.settings["ImageCheckURL"]}/{operation_id}',
                 headers=self.headers,
             )
-            if response.status_code == 200:
-                response_data = response.json()
-                if "response" in response_data:
-                    if "image" in response_data["response"]:
-                        return response_data["response"]["image"]
-                elif "done" in response_data:
-                    if response_data["done"] == False:
-                        if i >= iterations:
-                            logger.error(f'YandexART: Image generation took too long. Iterations: {i}. Delay: {delay}.')
-                            return None
-                        logger.debug(f'YandexART: Image is not ready yet. Iteration: {i}/{iterations}.')
-                        i += 1
-                        await asyncio.sleep(delay)
-                else:
-                    logger.error(f'YandexART Error: Could not check image generation. Response: {response_data}')
-                    return None                    
-            else:
+            if response.status_code != 200:
                 logger.error(f'YandexART Error: Could not check image generation (status code: {response.status_code}). Response: {response.text}')
                 return None
+            response_data = response.json()
+            if "response" in response_data and "image" in response_data["response"]:
+                return response_data["response"]["image"]
+            if "error" in response_data or response_data.get("done") != False:
+                logger.error(f'YandexART Error: Could not check image generation. Response: {response_data}')
+                return None
+            if loop.time() >= finish:
+                logger.error(f'YandexART: Image generation took too long. Checks: {i}. Deadline: {deadline}s.')
+                return None
+            logger.debug(f'YandexART: Image is not ready yet. Check: {i}, next in {round(delay, 2)}s.')
+            delay = min(delay * factor, max_delay)
         
     async def imagine(self, prompt, id=0, seed=-1, revision=False):
         '''
@@ -609,7 +622,7 @@ class YandexEngine:
                 data["generationOptions"]["seed"] = str(seed)
 
             logger.debug(f'YandexART request. Prompt: {prompt}. Seed: {seed}.')
-            response = self.requests.post(
+            response = await self.http.post(
                 self.settings["ImageGenURL"],
                 headers=self.headers,
                 json=data,
@@ -619,19 +632,21 @@ class YandexEngine:
                 # we should check API if image was done
                 response_data = response.json()
                 logger.debug(f'YandexART response: {response_data}')
-                if "id" in response_data:
-                    operation_id = response_data["id"]
-                    # check if image was generated
-                    image = await self.check_image_generation(operation_id) # returns base64 image or None
-                    if image is None:
-                        logger.error(f'YandexART Error: Could not retrieve image.')
-                        return None, 'Could not retrieve image. Please try again.'
+                if "id" not in response_data:
+                    logger.error(f'YandexART Error: No operation id in response: {response_data}')
+                    return None, 'Could not generate image. Please try again later or contact support.'
+                operation_id = response_data["id"]
+                # check if image was generated
+                image = await self.check_image_generation(operation_id) # returns base64 image or None
+                if image is None:
+                    logger.error(f'YandexART Error: Could not retrieve image.')
+                    return None, 'Could not retrieve image. Please try again.'
                 revised_prompt = f"Prompt: {prompt}. Seed: {seed}." if revision else None
                 logger.info(f'YandexART generated image.')
                 return image, revised_prompt
             elif response.status_code == 400:
                 logger.error(f'YandexART BadRequestError: {response.text}')
-                logger.debug(f'YandexART request data: {response.request.body}')
+                logger.debug(f'YandexART request data: {data}')
                 return None, 'Request was rejected. Please try later or contact support.'
             elif response.status_code == 403:
                 logger.error(f'YandexART ContentModerationError: {response.text}')
@@ -10,11 +10,27 @@ Metrics include:
     - Cost per user
 '''
 import pickle
+import sqlite3
 import time
+import os
 
-chats = pickle.load(open('../data/tech/chats.pickle', 'rb'))
-stats = pickle.load(open('../data/tech/stats.pickle', 'rb'))
-rates = pickle.load(open('../data/tech/ratelimit.pickle', 'rb'))
+# chat history is stored in SQLite database, as per-user logs (./data/tech/chats/<id>.log) or in a legacy pickle file
+if os.path.exists('../data/tech/sirchatalot.db'):
+    conn = sqlite3.connect('file:../data/tech/sirchatalot.db?mode=ro', uri=True)
+    chats = {row[0]: None for row in conn.execute('SELECT DISTINCT user_id FROM messages')}
+    stats, rates = {}, {}
+    for userid, key, value in conn.execute('SELECT user_id, key, value FROM stats'):
+        stats.setdefault(userid, {})[key] = value
+    for userid, ts in conn.execute('SELECT user_id, ts FROM rate_events'):
+        rates.setdefault(userid, []).append(ts)
+    conn.close()
+else:
+    if os.path.exists('../data/tech/chats.pickle'):
+        chats = pickle.load(open('../data/tech/chats.pickle', 'rb'))
+    else:
+        chats = {filename[:-len('.log')]: None for filename in os.listdir('../data/tech/chats') if filename.endswith('.log')}
+    stats = pickle.load(open('../data/tech/stats.pickle', 'rb'))
+    rates = pickle.load(open('../data/tech/ratelimit.pickle', 'rb'))
 
 # Calculate total cost of chatbot
 total_cost = 0
@@ -18,16 +18,74 @@ handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
 handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
 logger.addHandler(handler)
 
-import pickle
-import os
 from pydub import AudioSegment
 from datetime import datetime
 import json
-import codecs
+import bisect
+import itertools
+import time
+import asyncio
+import weakref
 
 from chatutils.audio_engines import get_audio_engine
 # Support: OpenAI API, YandexGPT API, Claude API
-from chatutils.engines import OpenAIEngine, YandexEngine, AnthropicEngine
+from chatutils.engines import OpenAIEngine, YandexEngine, AnthropicEngine, summary_cache
+from chatutils.storage import get_chat_store, WriteBehind, ChatCache, FileCatalog
+from chatutils.blobs import get_blob_store
+from chatutils.http_session import close_http_client
+
+######## System prompt layout ########
+
+# Layout of system message:
+#   1. persona (style system message) - static
+#   2. tool hints - static, depend only on configuration
+#   3. file catalog - canonical JSON, changes only when files are changed
+# The message is the same for every turn while files are not changed, so provider prefix caches are hit.
+# Stored messages are not versioned: the catalog is always re-rendered after FILES_MARKER (see get_persona).
+FILES_MARKER = '# Available files:'
+FILES_HINT = 'Use semantic search to find information in the files when you think it can be there.'
+
+def catalog_json(files) -> str:
+    '''
+    Canonical serialization of files of one owner: {filename: summary} with sorted keys
+    '''
+    return json.dumps({filename: files[filename].get('summary') for filename in sorted(files)}, ensure_ascii=False, sort_keys=True)
+
+def render_catalog(available_docs, user_id) -> str:
+    '''
+    File catalog part of system message for a user (tool hint and files), empty if there are no files
+    Input:
+        * available_docs - metadata of files {owner: {filename: {"summary": str, ...}}}
+        * user_id - id of user
+    '''
+    user_files = available_docs.get(str(user_id))
+    common_files = available_docs.get('common')
+    if not user_files and not common_files:
+        return ''
+    files_text = f'{FILES_MARKER}\n{FILES_HINT}\n'
+    if user_files:
+        files_text += f'## User files: {catalog_json(user_files)}\n'
+    if common_files:
+        files_text += f'## Common files: {catalog_json(common_files)}\n'
+    return files_text.rstrip('\n')
+
+def build_system_prompt(persona, catalog='') -> str:
+    '''
+    Compose system message (see layout above)
+    Input:
+        * persona - style system message (without file catalog)
+        * catalog - rendered file catalog (see `render_catalog`)
+    '''
+    parts = [persona.rstrip('\n')]
+    if catalog:
+        parts.append(catalog)
+    return '\n'.join(parts)
+
+def get_persona(system_message) -> str:
+    '''
+    Persona part of system message (everything from FILES_MARKER on is removed)
+    '''
+    return system_message.split(FILES_MARKER)[0].rstrip('\n')
 
 class ChatProc:
     def __init__(self, text="OpenAI", speech="OpenAI") -> None:
@@ -50,6 +108,9 @@ class ChatProc:
         
         self.model_prompt_price = self.text_engine.model_prompt_price
         self.model_completion_price = self.text_engine.model_completion_price
+        # prices of prompt cache writes and reads (only for engines with prompt caching)
+        self.model_cache_write_price = getattr(self.text_engine, 'model_cache_write_price', 0)
+        self.model_cache_read_price = getattr(self.text_engine, 'model_cache_read_price', 0)
         self.max_tokens = self.text_engine.max_tokens
         self.summarize_too_long = self.text_engine.summarize_too_long
         
@@ -80,8 +141,13 @@ class ChatProc:
             self.files_rag = FilesRAG()
             logger.debug(f'Files processing is enabled')
 
+        self.webengine = None
+        self.urlopener = None
+        self.available_functions = {}
         self.function_calling = self.text_engine.function_calling
         if self.function_calling:
+            self.max_tool_depth = self.text_engine.max_tool_depth
+            self.tool_timeout = self.text_engine.tool_timeout
             self.load_function_calling(text)
             self.text_engine.function_calling_tools = self.function_calling_tools
             logger.debug(f'Function calling is enabled')
@@ -114,19 +180,76 @@ class ChatProc:
 
         self.file_summary_tokens = int(config.get("Files", "MaxSummaryTokens")) if config.has_option("Files", "MaxSummaryTokens") else (self.max_tokens // 2)
         self.max_file_length = int(config.get("Files", "MaxFileLength")) if config.has_option("Files", "MaxFileLength") else 10000
+        # max number of chunks of a file summarized at the same time
+        self.summary_concurrency = max(config.getint("Files", "SummaryConcurrency", fallback=4), 1)
 
-        # load chat history from file
-        self.chats_location = "./data/tech/chats.pickle"
-        self.chats = self.load_pickle(self.chats_location)
-        # load statistics from file
-        self.stats_location = "./data/tech/stats.pickle"
-        self.stats = self.load_pickle(self.stats_location)
+        self.chat_store = get_chat_store()
+        # load statistics from storage
+        self.stats = self.chat_store.load_stats()
+        # changes are written to storage in background (see start/stop)
+        self.write_behind = WriteBehind(
+            self.chat_store, 
+            self.stats,
+            interval=config.getfloat("Storage", "FlushInterval", fallback=2.0),
+            max_dirty=config.getint("Storage", "FlushSize", fallback=50),
+        )
+        # chat history is loaded from storage on demand, only recently active users are kept in memory
+        self.chats = ChatCache(
+            self.chat_store,
+            self.write_behind,
+            max_users=config.getint("Storage", "CacheUsers", fallback=1000),
+            max_bytes=config.getint("Storage", "CacheMB", fallback=256) * 1024 * 1024,
+        )
+        # metadata of processed files is kept in memory, rendered catalog is cached per user
+        self.file_catalog = FileCatalog(self.chat_store, render=render_catalog)
+        # updates of one user are processed one by one, updates of different users - concurrently
+        # (lock is dropped when nobody holds or waits for it)
+        self.user_locks = weakref.WeakValueDictionary()
 
 
 
         if self.log_chats:
             logger.info('* Chat history is logged *')
 
+    def user_lock(self, id) -> asyncio.Lock:
+        '''
+        Get lock of user (use `async with gpt.user_lock(id):` to process user's updates in order)
+        '''
+        lock = self.user_locks.get(id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.user_locks[id] = lock
+        return lock
+
+    async def start(self):
+        '''
+        Start background tasks (must be called from the running event loop)
+        '''
+        try:
+            # images that are not referenced by chats and sessions anymore (deleted, trimmed, summarized)
+            await asyncio.to_thread(get_blob_store().collect, self.chat_store.all_messages())
+        except Exception as e:
+            logger.exception('Could not delete images that are not referenced anymore')
+        await self.write_behind.start()
+        if self.webengine is not None or self.urlopener is not None:
+            from chatutils.web_engines import start_web_session
+            await start_web_session()
+
+    async def stop(self):
+        '''
+        Stop background tasks, write all pending changes to disk
+        '''
+        await self.write_behind.stop()
+        self.chat_store.close()
+        await close_http_client()
+        if self.webengine is not None or self.urlopener is not None:
+            from chatutils.web_engines import close_web_session
+            await close_web_session()
+        logger.info(f'Chat cache statistics: {self.chats.info()}')
+        if summary_cache is not None:
+            logger.info(f'Summary cache statistics: {summary_cache.info()}')
+        logger.info(f'Prompt cache statistics: {self.text_engine.prompt_cache.info()}')
+
     def load_function_calling(self, text):
         '''
         Load function calling tools
@@ -325,7 +448,7 @@ class ChatProc:
             
             # Check if there is a chat
             new_chat = False
-            if id not in self.chats:
+            if not await self.chats.has(id):
                 # If there is no chat, then create it
                 success = await self.init_style(id=id)
                 if not success:
@@ -334,23 +457,23 @@ class ChatProc:
                 new_chat = True
 
             messages = self.chats[id]
-            messages.append({
+            message = {
                 "role": "user", 
                 "content": [
                     {
                         "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_b64}"
-                        },
+                        # image is saved once in blob store, message keeps only a reference
+                        "image_url": await get_blob_store().image_url(image_b64),
                     }
                 ] 
-            })
+            }
+            messages.append(message)
             # Add flag that there is an image without caption
             self.pending_images[id] = True
             # save chat history
             self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            # save chat history to storage
+            self.write_behind.chat_changed(id, messages)
             return True
         except Exception as e:
             logger.exception('Could not add image to chat for user: ' + str(id))
@@ -367,7 +490,7 @@ class ChatProc:
                 return False
             
             # Check if there is a chat
-            if id not in self.chats:
+            if not await self.chats.has(id):
                 logger.error('Could not add caption to image. No chat for user: ' + str(id))
                 return False
             
@@ -384,8 +507,8 @@ class ChatProc:
             })
             # save chat history
             self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            # save changed message to storage
+            self.write_behind.chat_changed(id, messages, index=len(messages) - 1)
             return True
         except Exception as e:
             logger.exception('Could not add caption to image for user: ' + str(id))
@@ -410,14 +533,14 @@ class ChatProc:
             if self.function_calling:
                 style += '\n# You have function calling (tools) enabled'
             # get messages if chat exists
-            if id in self.chats:
+            if await self.chats.has(id):
                 messages = self.chats[id]
             else:
                 messages = [{"role": "system", "content": style}]
             # save chat history
             self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            # save chat history to storage
+            self.write_behind.chat_changed(id, messages)
             return True
         except Exception as e:
             logger.exception('Could not init style for user: ' + str(id))
@@ -431,7 +554,7 @@ class ChatProc:
             * message - message to add to chat history (JSON format: {"role": "user", "content": "message"})
         '''
         try:
-            if id not in self.chats:
+            if not await self.chats.has(id):
                 # If there is no chat, then create it
                 success = await self.init_style(id=id)
                 if not success:
@@ -441,8 +564,8 @@ class ChatProc:
             messages.append(message)
             # save chat history
             self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            # save chat history to storage
+            self.write_behind.chat_changed(id, messages)
             return True
         except Exception as e:
             logger.error(f'Could not add message to chat history for user {id}: {e}')
@@ -457,7 +580,7 @@ class ChatProc:
             if messages is None:
                 logger.error('Could not save chat history. No messages provided')
                 return False
-            if id not in self.chats:
+            if not await self.chats.has(id):
                 # If there is no chat, then create it
                 success = await self.init_style(id=id)
                 if not success:
@@ -465,20 +588,20 @@ class ChatProc:
                     return False
             # save chat history
             self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            # save chat history to storage
+            self.write_behind.chat_changed(id, messages)
             logger.debug(f'Chat history for user {id} was saved successfully')
             return True
         except Exception as e:
             logger.error(f'Could not save chat history for user {id}: {e}')
             return False
         
-    async def count_tokens(self, messages):
+    async def count_tokens(self, messages, each=False):
         '''
         Count tokens in messages
-        Input messages
+        Input messages, each - return number of tokens in every message instead of total
         '''
-        return await self.text_engine.count_tokens(messages)
+        return await self.text_engine.count_tokens(messages, each=each)
     
     async def chat_summary(self, messages):
         '''
@@ -487,21 +610,47 @@ class ChatProc:
         '''
         return await self.text_engine.chat_summary(messages)
 
-    async def trim_messages(self, messages, trim_count=1):
+    def is_tool_result(self, message) -> bool:
+        '''
+        Check if message is a result of a tool call (it can not be the first message after trimming)
+        '''
+        if message['role'] in ('function', 'tool'):
+            return True
+        content = message['content']
+        if type(content) == list:
+            return any(type(part) == dict and part.get('type') == 'tool_result' for part in content)
+        return False
+
+    async def trim_messages(self, messages, max_tokens=None):
         '''
-        Trim messages (delete first trim_count messages)
-        Do not trim system message (role == 'system', id == 0)
+        Trim the oldest messages so that chat fits into max_tokens (80% of model max tokens by default)
+        Tokens of every message are counted once, cut point is found with binary search over prefix sums
+        Do not trim system message (role == 'system', id == 0), do not leave tool results without tool calls
         '''
         try:
             if messages is None or len(messages) <= 1:
                 logger.warning('Could not trim messages')
                 return None
+            if max_tokens is None:
+                max_tokens = int(self.max_tokens*0.8)
             system_message = messages[0] if messages[0]['role'] == 'system' else {"role": "system", "content": self.system_message}
             messages = messages[1:] if messages[0]['role'] == 'system' else messages
-            logger.debug(f'Deleting messages: {messages[:trim_count]}')
-            messages = messages[trim_count:]
-            messages.insert(0, system_message)
-            return messages
+            # all messages are counted with one batch, prefix[i] - tokens in messages[:i]
+            counts = await self.count_tokens([system_message] + messages, each=True)
+            if counts is None:
+                logger.warning('Could not trim messages: tokens were not counted')
+                return None
+            prefix = [0] + list(itertools.accumulate(counts[1:]))
+            budget = max_tokens - counts[0]
+            # first index where the rest of the chat fits into the budget
+            cut = bisect.bisect_left(prefix, prefix[-1] - budget)
+            while cut < len(messages) and self.is_tool_result(messages[cut]):
+                cut += 1
+            if cut >= len(messages):
+                logger.warning('Could not trim messages: the last message does not fit into max tokens')
+                return None
+            logger.debug(f'Deleting {cut} messages ({prefix[cut]} tokens)')
+            return [system_message] + messages[cut:]
         except Exception as e:
             logger.error(f'Could not trim messages: {e}')
             return None
@@ -535,18 +684,21 @@ class ChatProc:
             logger.error(f'Could not summarize messages: {e}')
             return None, {"prompt": 0, "completion": 0}
 
-    async def chat(self, id=0, message="Hi! Who are you?", style=None):
+    async def chat(self, id=0, message="Hi! Who are you?", style=None, on_delta=None):
         '''
         Chat with GPT
         Input:
             * id - id of user
             * message - message to chat with GPT
             * style - style of chat (default: None)
+            * on_delta - async function that receives parts of answer while it is generated (streaming, default: None)
         '''
         try:
             prompt_tokens, completion_tokens = 0, 0
+            # tokens written to and read from prompt cache (counted separately from prompt tokens)
+            cache_write_tokens, cache_read_tokens = 0, 0
             # Init style if it is not set
-            if id not in self.chats:
+            if not await self.chats.has(id):
                 success = await self.init_style(id=id, style=style)
                 if not success:
                     logger.error('Could not init style for user: ' + str(id))
@@ -563,31 +715,22 @@ class ChatProc:
                 await self.add_to_chat_history(id=id, message={"role": "user", "content": message})
 
             # Add to system message information about available files
+            # (message is rewritten only when the catalog is changed, so its prefix stays cacheable)
             if self.files_processing and "semantic_search" in self.available_functions:
-                if os.path.exists('./data/files/files.json'):
-                    with codecs.open('./data/files/files.json', 'r', 'utf-8') as f:
-                        available_docs = json.load(f) 
-                else:
-                    available_docs = {}
-                    
-                user_id_str = str(id)
-                if user_id_str in available_docs or 'common' in available_docs:
-                    add_text = '\n# Available files:\n'
-                    if user_id_str in available_docs:
-                        add_text += f'## User files: {available_docs[user_id_str]}\n'
-                    if 'common' in available_docs:
-                        add_text += f'## Common files: {available_docs["common"]}\n'
-                    add_text += '---\nUse semantic search to find information in the files when you think it can be there.'
-                    # modify first message if it's role system
-                    if messages[0]['role'] == 'system':
-                        if '# Available files:' in messages[0]['content']:
-                            messages[0]['content'] = messages[0]['content'].split('# Available files:')[0]
-                        messages[0]['content'] += add_text
-                    else:
-                        messages.insert(0, {"role": "system", "content": f'{self.system_message}\n{add_text}'})
+                catalog = self.file_catalog.fragment(id)
+                if messages[0]['role'] == 'system':
+                    system_prompt = build_system_prompt(get_persona(messages[0]['content']), catalog)
+                    if system_prompt != messages[0]['content']:
+                        logger.debug(f'System message of user {id} was changed')
+                        messages[0]['content'] = system_prompt
+                        self.chats[id] = messages
+                        # save changed system message to storage
+                        self.write_behind.chat_changed(id, messages, index=0)
+                elif catalog:
+                    messages.insert(0, {"role": "system", "content": build_system_prompt(self.system_message, catalog)})
                     self.chats[id] = messages
-                    # save chat history to file
-                    pickle.dump(self.chats, open(self.chats_location, "wb"))
+                    # save chat history to storage
+                    self.write_behind.chat_changed(id, messages)
 
             # Trim or summarize messages if they are too long
             messages_tokens = await self.count_tokens(messages)
@@ -595,8 +738,7 @@ class ChatProc:
                 messages_tokens = 0
             if messages_tokens > self.max_tokens:
                 if not self.summarize_too_long:
-                    while await self.count_tokens(messages) > int(self.max_tokens*0.8):
-                        messages = await self.trim_messages(messages)
+                    messages = await self.trim_messages(messages)
                 else:
                     messages, token_usage = await self.summarize_messages(messages)
                     prompt_tokens += int(token_usage['prompt'])
@@ -605,210 +747,144 @@ class ChatProc:
                     return 'There was an error due to a long conversation. Please, contact the administrator or /delete your chat history.'
 
             # Wait for response
-            response, messages, token_usage = await self.text_engine.chat(id=id, messages=messages)
+            response, messages, token_usage = await self.text_engine.chat(id=id, messages=messages, on_delta=on_delta)
             # add statistics
             if token_usage is not None:
                 prompt_tokens += int(token_usage['prompt'])
                 completion_tokens += int(token_usage['completion'])
-            # TODO: check if function was called
-            if self.function_calling:
-                if type(response) == tuple:
-                    if response[0] == 'function':
-                        function_name, function_args = response[1], response[2]
-                        corresponding_text, tool_id = response[4], response[5]
-                        logger.debug(f'Function was called: "{function_name}" with arguments: "{function_args}". Corresponding text: "{corresponding_text}". Tool ID: {tool_id}')
-                        if response[1] == 'generate_image':
-                            # call function to generate image
-                            function_to_call = self.available_functions[function_name]
-                            function_response = await function_to_call(
-                                prompt = function_args.get("prompt"),
-                                image_orientation = function_args.get("image_orientation"),
-                                image_style = function_args.get("image_style"),
-                            )
-                            image, text = function_response[0], function_response[1]
-                            if image is not None:
-                                # add to chat history
-                                if type(self.text_engine) == AnthropicEngine:
-                                    # https://docs.anthropic.com/claude/docs/tool-use-examples
-                                    # assistant:
-                                    message_content = []
-                                    if corresponding_text is not None:
-                                        if len(corresponding_text) > 0:
-                                            message_content.append({"type": "text", "text": corresponding_text})
-                                    message_content.append({"type": "tool_use", "id": tool_id, "name": function_name, "input": function_args})
-                                    await self.add_to_chat_history(id=id, 
-                                        message={"role": "assistant", "content": message_content})
-                                    # user (function response)
-                                    message_content = [{
-                                        "type": "tool_result",
-                                        "tool_use_id": tool_id,
-                                        "content": f"Image was generated from the prompt: {function_args.get('prompt')} (Revised prompt: {text})",
-                                    }]
-                                    await self.add_to_chat_history(id=id, 
-                                        message={"role": "user", "content": message_content})  
-                                else:
-                                    await self.add_to_chat_history(id=id, 
-                                        message={"role": "function", "name": function_name, "content": str(text)})
-                                # add statistics
-                                await self.add_stats(id=id, images_generated=1)
-                                response = ('image', image, text)
-                            elif image is None and text is not None:
-                                response = f'Image was not generated. {text}'
-                                await self.add_to_chat_history(id=id, 
-                                    message={"role": "assistant", "content": response})
-                            else:
-                                response = 'Sorry, something went wrong.'
-                                logger.error(f'Function was called, but image was not generated: {response}')
-                        elif response[1] == 'web_search':
-                            # call function to search the web
-                            function_to_call = self.available_functions[function_name]
-                            function_response = await function_to_call(
-                                query = function_args.get("query"),
-                            )
-                            if function_response is None:
-                                function_response = 'Error while searching the web'
-                            if type(self.text_engine) == AnthropicEngine:
-                                # https://docs.anthropic.com/claude/docs/tool-use-examples
-                                # assistant:
-                                message_content = []
-                                if corresponding_text is not None:
-                                    if len(corresponding_text) > 0:
-                                        message_content.append({"type": "text", "text": corresponding_text})
-                                message_content.append({"type": "tool_use", "id": tool_id, "name": function_name, "input": function_args})
-                                await self.add_to_chat_history(id=id, 
-                                    message={"role": "assistant", "content": message_content})
-                                # user (function response)
-                                message_content = [{
-                                    "type": "tool_result",
-                                    "tool_use_id": tool_id,
-                                    "content": f"Web search results for: {function_args.get('query')}: {function_response}",
-                                }]
-                                await self.add_to_chat_history(id=id,
-                                    message={"role": "user", "content": message_content})
-                            else:
-                                await self.add_to_chat_history(id=id, 
-                                    message={"role": "function", "name": function_name, "content": str(function_response)})
-                            # Push response to LLM again
-                            messages = self.chats[id]
-                            logger.debug(f'Pushing response to LLM again')
-                            logger.debug(f'messages: {messages}')
-                            response, messages, token_usage = await self.text_engine.chat(id=id, messages=messages)
-                            # add statistics
-                            if token_usage is not None:
-                                prompt_tokens += int(token_usage['prompt'])
-                                completion_tokens += int(token_usage['completion'])
-                            if response is None:
-                                response = 'Sorry, I could not get an answer to your message. Please try again or contact the administrator.'
-                            else:
-                                await self.save_chat(id=id, messages=messages)
-                        elif response[1] == 'url_opener':
-                            # call function to open URL
-                            function_to_call = self.available_functions[function_name]
-                            function_response = await function_to_call(
-                                url = function_args.get("url"),
-                            )
-                            if function_response is None:
-                                function_response = 'Error while opening the URL or there was no content'
-                            elif self.url_summary:
-                                # create summary of the content
-                                logger.debug(f'Attempting to summarize the content of the URL ({len(function_response)})')
-                                function_response, token_usage = await self.text_engine.summary(f'User message: {message}. Text from URL: {function_response}')
-                                if function_response is None:
-                                    function_response = 'Error while summarizing the content of the URL'
-                                else:
-                                    prompt_tokens += int(token_usage['prompt'])
-                                    completion_tokens += int(token_usage['completion'])
-                            else:
-                                pass
-                            if type(self.text_engine) == AnthropicEngine:
-                                # https://docs.anthropic.com/claude/docs/tool-use-examples
-                                # assistant:
-                                message_content = []
-                                if corresponding_text is not None:
-                                    if len(corresponding_text) > 0:
-                                        message_content.append({"type": "text", "text": corresponding_text})
-                                message_content.append({"type": "tool_use", "id": tool_id, "name": function_name, "input": function_args})
-                                await self.add_to_chat_history(id=id, 
-                                    message={"role": "assistant", "content": message_content})
-                                # user (function response)
-                                message_content = [{
-                                    "type": "tool_result",
-                                    "tool_use_id": tool_id,
-                                    "content": f"URL ({function_args.get('url')}) opened. Content: {function_response}",
-                                }]
-                                await self.add_to_chat_history(id=id,
-                                    message={"role": "user", "content": message_content})
-                            else:
-                                await self.add_to_chat_history(
-                                    id=id, 
-                                    message={"role": "function", "name": function_name, "content": f"URL content: {function_response}"}
-                                    )
-                            # Push response to LLM again
-                            messages = self.chats[id]
-                            logger.debug(f'Pushing response of URL opener to LLM again: {function_response}')
-                            response, messages, token_usage = await self.text_engine.chat(id=id, messages=messages)
-                            # add statistics
-                            if token_usage is not None:
-                                prompt_tokens += int(token_usage['prompt'])
-                                completion_tokens += int(token_usage['completion'])
-                            if response is None:
-                                response = 'Sorry, I could not get an answer to your message. Please try again or contact the administrator.'
-                            else:
-                                await self.save_chat(id=id, messages=messages)
-                        elif response[1] == 'semantic_search':
-                                function_to_call = self.available_functions[function_name]
-                                logger.debug(f'Calling function: {function_name} with arguments: {function_args}')
-                                function_response = await function_to_call(
-                                    text = function_args.get("text"),
-                                    n_results = function_args.get("n_results"),
-                                    user_id = id,
-                                )
-                                if function_response is None:
-                                    function_response = 'Error while searching the RAG database'
-                                if type(self.text_engine) == AnthropicEngine:
-                                    # https://docs.anthropic.com/claude/docs/tool-use-examples
-                                    # assistant:
-                                    message_content = []
-                                    if corresponding_text is not None:
-                                        if len(corresponding_text) > 0:
-                                            message_content.append({"type": "text", "text": corresponding_text})
-                                    message_content.append({"type": "tool_use", "id": tool_id, "name": function_name, "input": function_args})
-                                    await self.add_to_chat_history(id=id, 
-                                        message={"role": "assistant", "content": message_content})
-                                    # user (function response)
-                                    message_content = [{
-                                        "type": "tool_result",
-                                        "tool_use_id": tool_id,
-                                        "content": f"Semantic search results for: {function_args.get('text')}: {function_response}",
-                                    }]
-                                    await self.add_to_chat_history(id=id,
-                                        message={"role": "user", "content": message_content})
-                                else:
-                                    await self.add_to_chat_history(id=id, 
-                                        message={"role": "function", "name": function_name, "content": str(function_response)})
-                                # Push response to LLM again
-                                messages = self.chats[id]
-                                logger.debug(f'Pushing response to LLM again')
-                                logger.debug(f'messages: {messages}')
-                                response, messages, token_usage = await self.text_engine.chat(id=id, messages=messages)
-                                # add statistics
-                                if token_usage is not None:
-                                    prompt_tokens += int(token_usage['prompt'])
-                                    completion_tokens += int(token_usage['completion'])
-                                if response is None:
-                                    response = 'Sorry, I could not get an answer to your message. Please try again or contact the administrator.'
-                                else:
-                                    await self.save_chat(id=id, messages=messages)
-            else:
-                # save chat history
+                cache_write_tokens += int(token_usage.get('cache_write', 0))
+                cache_read_tokens += int(token_usage.get('cache_read', 0))
+            # tool calls: all calls of one turn are run concurrently, results are sent to the model again
+            depth, history_length = 0, len(messages) if messages is not None else 0
+            while self.function_calling and type(response) == tuple and response[0] == 'function':
+                tool_calls, corresponding_text = response[1], response[3]
+                if depth >= self.max_tool_depth:
+                    logger.warning(f'Max tool depth ({self.max_tool_depth}) was reached for user {id}, calls are skipped: {tool_calls}')
+                    response = corresponding_text or 'Sorry, I could not finish the answer, too many tools were needed. Please try to split your request.'
+                    messages.append({"role": "assistant", "content": response})
+                    break
+                depth += 1
+                logger.debug(f'Functions were called (turn {depth}): {tool_calls}. Corresponding text: "{corresponding_text}"')
+                messages.append(self.text_engine.tool_call_message(tool_calls, corresponding_text))
+                results = await asyncio.gather(*[self.run_tool(id, call, message) for call in tool_calls])
+                image = None
+                for content, tool_image, token_usage in results:
+                    prompt_tokens += int(token_usage['prompt'])
+                    completion_tokens += int(token_usage['completion'])
+                    if tool_image is not None:
+                        image = tool_image
+                messages.extend(self.text_engine.tool_result_messages([(call, result[0]) for call, result in zip(tool_calls, results)]))
                 await self.save_chat(id=id, messages=messages)
+                if image is not None:
+                    # generated image is the answer
+                    response = ('image', image[0], image[1])
+                    break
+                # Push results to LLM again
+                logger.debug(f'Pushing results of {len(tool_calls)} tool calls to LLM again')
+                sent_length = len(messages)
+                response, new_messages, token_usage = await self.text_engine.chat(id=id, messages=messages, on_delta=on_delta)
+                # add statistics
+                if token_usage is not None:
+                    prompt_tokens += int(token_usage['prompt'])
+                    completion_tokens += int(token_usage['completion'])
+                    cache_write_tokens += int(token_usage.get('cache_write', 0))
+                    cache_read_tokens += int(token_usage.get('cache_read', 0))
+                if new_messages is None or len(new_messages) < sent_length:
+                    # request failed: engine drops only the last message, so tool calls are removed
+                    # from history together with the user message (tool results can not be left without calls)
+                    messages = messages[:history_length - 1]
+                    break
+                messages = new_messages
+            # save chat history
+            if messages is not None and type(response) != tuple:
+                await self.save_chat(id=id, messages=messages)
+            if response is None and depth > 0:
+                response = 'Sorry, I could not get an answer to your message. Please try again or contact the administrator.'
             # add statistics
-            await self.add_stats(id=id, prompt_tokens_used=prompt_tokens, completion_tokens_used=completion_tokens)
+            await self.add_stats(id=id, prompt_tokens_used=prompt_tokens, completion_tokens_used=completion_tokens,
+                                 cache_write_tokens_used=cache_write_tokens, cache_read_tokens_used=cache_read_tokens)
             return response
         except Exception as e:
             logger.exception('Could not get answer to message: ' + message + ' from user: ' + str(id))
             return 'Sorry, I could not get an answer to your message. Please try again or contact the administrator.'
         
+    async def run_tool(self, id, tool_call, message=None):
+        '''
+        Run tool called by the model (with timeout), errors are returned to the model as text
+        Input:
+            * id - id of user
+            * tool_call - {"id": str, "name": str, "args": dict}
+            * message - user message (used for URL summary)
+        Output:
+            * content - result for the model
+            * image - (image, text) if image was generated, otherwise None
+            * token_usage - tokens used by the tool (dict - {"prompt": int, "completion": int})
+        '''
+        function_name, function_args = tool_call['name'], tool_call['args']
+        try:
+            if function_name not in self.available_functions:
+                return f'Function {function_name} is not available', None, {"prompt": 0, "completion": 0}
+            if function_args is None:
+                return f'Arguments of function {function_name} could not be parsed', None, {"prompt": 0, "completion": 0}
+            logger.debug(f'Calling function: {function_name} with arguments: {function_args}')
+            return await asyncio.wait_for(self.call_tool(id, function_name, function_args, message), timeout=self.tool_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f'Function {function_name} timed out after {self.tool_timeout} seconds')
+            return f'Function {function_name} timed out', None, {"prompt": 0, "completion": 0}
+        except Exception as e:
+            logger.exception(f'Could not call function {function_name}')
+            return f'Error while calling function {function_name}', None, {"prompt": 0, "completion": 0}
+
+    async def call_tool(self, id, function_name, function_args, message=None):
+        '''
+        Call tool, see `run_tool` for output
+        '''
+        token_usage = {"prompt": 0, "completion": 0}
+        function_to_call = self.available_functions[function_name]
+        if function_name == 'generate_image':
+            image, text = await function_to_call(
+                prompt = function_args.get("prompt"),
+                image_orientation = function_args.get("image_orientation"),
+                image_style = function_args.get("image_style"),
+            )
+            if image is None:
+                return f'Image was not generated. {text}', None, token_usage
+            # add statistics
+            await self.add_stats(id=id, images_generated=1)
+            return f"Image was generated from the prompt: {function_args.get('prompt')} (Revised prompt: {text})", (image, text), token_usage
+        elif function_name == 'web_search':
+            function_response = await function_to_call(
+                query = function_args.get("query"),
+            )
+            if function_response is None:
+                function_response = 'Error while searching the web'
+            return f"Web search results for: {function_args.get('query')}: {function_response}", None, token_usage
+        elif function_name == 'url_opener':
+            function_response = await function_to_call(
+                url = function_args.get("url"),
+            )
+            if function_response is None:
+                function_response = 'Error while opening the URL or there was no content'
+            elif self.url_summary:
+                # create summary of the content
+                logger.debug(f'Attempting to summarize the content of the URL ({len(function_response)})')
+                function_response, summary_usage = await self.text_engine.summary(f'User message: {message}. Text from URL: {function_response}')
+                if function_response is None:
+                    function_response = 'Error while summarizing the content of the URL'
+                else:
+                    token_usage = summary_usage
+            return f"URL ({function_args.get('url')}) opened. Content: {function_response}", None, token_usage
+        elif function_name == 'semantic_search':
+            function_response = await function_to_call(
+                text = function_args.get("text"),
+                n_results = function_args.get("n_results"),
+                user_id = id,
+            )
+            if function_response is None:
+                function_response = 'Error while searching the RAG database'
+            return f"Semantic search results for: {function_args.get('text')}: {function_response}", None, token_usage
+        return f'Function {function_name} is not supported', None, token_usage
+
     async def imagine(self, id=0, prompt=None, add_to_chat=True):
         '''
         Generate image from text
@@ -856,20 +932,8 @@ class ChatProc:
             logger.exception('Could not generate image from prompt: ' + prompt + ' for user: ' + str(id))
             return None, 'Sorry, I could not generate an image from your prompt.'
             
-    def load_pickle(self, filepath):
-        '''
-        Load pickle file if exists or create new 
-        '''
-        try:
-            payload = pickle.load(open(filepath, "rb")) 
-            return payload
-        except Exception as e:
-            payload = {}
-            pickle.dump(payload, open(filepath, "wb"))
-            logger.debug(f'Could not load file: {filepath}. Created new file.')
-            return payload
-        
-    async def add_stats(self, id=None, speech2text_seconds=None, messages_sent=None, voice_messages_sent=None, prompt_tokens_used=None, completion_tokens_used=None, images_generated=None):
+    async def add_stats(self, id=None, speech2text_seconds=None, messages_sent=None, voice_messages_sent=None, prompt_tokens_used=None, completion_tokens_used=None, images_generated=None,
+                        cache_write_tokens_used=None, cache_read_tokens_used=None):
         '''
         Add statistics (tokens used, messages sent, voice messages sent) by user
         Input:
@@ -880,6 +944,8 @@ class ChatProc:
             * prompt_tokens_used - tokens used for prompt
             * completion_tokens_used - tokens used for completion
             * images_generated - images generated
+            * cache_write_tokens_used - prompt tokens written to prompt cache
+            * cache_read_tokens_used - prompt tokens read from prompt cache
         '''
         try:
             if id is None:
@@ -895,8 +961,13 @@ class ChatProc:
             self.stats[id]['Completion tokens used'] += completion_tokens_used if completion_tokens_used is not None else 0
             if self.image_generation:
                 self.stats[id]['Images generated'] += images_generated if images_generated is not None else 0
-            # save statistics to file (unsafe way)
-            pickle.dump(self.stats, open(self.stats_location, "wb"))
+            # prompt cache statistics are added only for users of engines with prompt caching
+            if cache_write_tokens_used:
+                self.stats[id]['Cache write tokens used'] = self.stats[id].get('Cache write tokens used', 0) + cache_write_tokens_used
+            if cache_read_tokens_used:
+                self.stats[id]['Cache read tokens used'] = self.stats[id].get('Cache read tokens used', 0) + cache_read_tokens_used
+            # save statistics (written in background)
+            self.write_behind.stats_changed()
         except KeyError as e:
             logger.error('Could not add statistics for user: ' + str(id))
             # add key to stats and try again
@@ -905,7 +976,7 @@ class ChatProc:
             current_stats[key_missing] = 0
             self.stats[id] = current_stats
             try:
-                pickle.dump(self.stats, open(self.stats_location, "wb"))
+                self.write_behind.stats_changed()
             except Exception as e:
                 logger.error('Could not add statistics for user after adding keys: ' + str(id))
         except Exception as e:
@@ -939,6 +1010,8 @@ class ChatProc:
                     cost += self.stats[id]['Speech to text seconds'] / 60 * self.s2t_model_price
                 cost += self.stats[id]['Prompt tokens used'] / 1000 * self.model_prompt_price 
                 cost += self.stats[id]['Completion tokens used'] / 1000 * self.model_completion_price
+                cost += self.stats[id].get('Cache write tokens used', 0) / 1000 * self.model_cache_write_price
+                cost += self.stats[id].get('Cache read tokens used', 0) / 1000 * self.model_cache_read_price
                 if self.image_generation:
                     cost += self.stats[id]['Images generated'] * self.image_generation_price
                 statisitics += '\nAppoximate cost of usage is $' + str(round(cost, 2))
@@ -952,7 +1025,7 @@ class ChatProc:
             current_stats[key_missing] = 0
             self.stats[id] = current_stats
             try:
-                pickle.dump(self.stats, open(self.stats_location, "wb"))
+                self.write_behind.stats_changed()
             except Exception as e:
                 logger.error(f'Could not get statistics for user {id} after adding keys: {e}')
             if counter > 6:
@@ -973,7 +1046,7 @@ class ChatProc:
             if id is None:
                 logger.debug('Could not dump chat. No ID provided')
                 return False
-            if id not in self.chats:
+            if not await self.chats.has(id):
                 return False
             if chatname is None:
                 chatname = datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -984,11 +1057,8 @@ class ChatProc:
                     for message in messages:
                         f.write(message['role'] + ': ' + message['content'] + '\n')
             else:
-                # dump chat to user file
-                filename = f'./data/chats/{id}.pickle'
-                chats = self.load_pickle(filename)
-                chats[chatname] = messages
-                pickle.dump(chats, open(filename, "wb"))
+                # save chat as a named session
+                self.chat_store.save_session(id, chatname, messages)
             return True
         except Exception as e:
             logger.exception('Could not dump chat for user: ' + str(id))
@@ -1000,12 +1070,12 @@ class ChatProc:
         Input id of user
         '''
         try:
-            if id not in self.chats:
+            if not await self.chats.has(id):
                 return False
             if self.log_chats:
                 await self.dump_chat(id=id, plain=True)
             del self.chats[id]
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            self.write_behind.chat_deleted(id)
             return True
         except Exception as e:
             logger.exception('Could not delete chat history for user: ' + str(id))
@@ -1019,11 +1089,9 @@ class ChatProc:
             if id is None:
                 logger.debug('Could not get stored chats. No ID provided')
                 return False
-            if id not in self.chats:
+            if not await self.chats.has(id):
                 return False
-            sessions = pickle.load(open("./data/chats/" + str(id) + ".pickle", "rb"))
-            # sessions names (dict keys)
-            names = list(sessions.keys())
+            names = self.chat_store.list_sessions(id)
             return names
         except Exception as e:
             logger.exception('Could not get stored chats for user: ' + str(id))
@@ -1040,11 +1108,13 @@ class ChatProc:
             if chatname is None:
                 logger.debug('Could not load chat. No chatname provided')
                 return False
-            sessions = pickle.load(open("./data/chats/" + str(id) + ".pickle", "rb"))
-            messages = sessions[chatname]
+            messages = self.chat_store.load_session(id, chatname)
+            if messages is None:
+                logger.debug(f'Could not load chat. No session {chatname} for user {id}')
+                return False
             # overwrite chat history
             self.chats[id] = messages
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+            self.write_behind.chat_changed(id, messages)
             return True
         except Exception as e:
             logger.exception('Could not load session for user: ' + str(id))
@@ -1061,9 +1131,7 @@ class ChatProc:
             if chatname is None:
                 logger.debug('Could not load chat. No chatname provided')
                 return False
-            sessions = pickle.load(open("./data/chats/" + str(id) + ".pickle", "rb"))
-            del sessions[chatname]
-            pickle.dump(sessions, open("./data/chats/" + str(id) + ".pickle", "wb"))
+            self.chat_store.delete_session(id, chatname)
             return True
         except Exception as e:
             logger.exception('Could not delete session for user: ' + str(id))
@@ -1079,24 +1147,110 @@ class ChatProc:
             if style is None:
                 style = self.system_message
             # get messages if chat exists
-            if id in self.chats:
+            if await self.chats.has(id):
                 messages = self.chats[id]
             else:
                 messages = [{"role": "system", "content": style}]
             # change style
-            if messages[0]['role'] == 'system':
+            if messages[0]['role'] == 'system' and await self.chats.has(id):
                 messages[0]['content'] = style 
+                # save changed system message to storage
+                self.chats[id] = messages
+                self.write_behind.chat_changed(id, messages, index=0)
             else:
-                messages.insert(0, {"role": "system", "content": style})
-            # save chat history
-            self.chats[id] = messages
-            # save chat history to file
-            pickle.dump(self.chats, open(self.chats_location, "wb"))
+                if messages[0]['role'] != 'system':
+                    messages.insert(0, {"role": "system", "content": style})
+                # save chat history to storage
+                self.chats[id] = messages
+                self.write_behind.chat_changed(id, messages)
             return True
         except Exception as e:
             logger.exception('Could not change style for user: ' + str(id))
             return False
 
+    async def split_tokens(self, text, chunk_tokens) -> list:
+        '''
+        Split text into chunks of at most `chunk_tokens` tokens
+        '''
+        encoding = self.text_engine.encoding
+        tokens = await self.text_engine.token_counter.tokens(text)
+        return [encoding.decode(tokens[i:i+chunk_tokens]) for i in range(0, len(tokens), chunk_tokens)]
+
+    async def summarize_text(self, text, max_tokens, sumdepth=3):
+        '''
+        Summarize long text with map-reduce
+            * map - text is split into chunks by tokens, chunks are summarized concurrently
+            * reduce - partial summaries are grouped into chunks and summarized again,
+              until the summary fits into `max_tokens` (at most `sumdepth` stages)
+        Input:
+            * text - text to summarize
+            * max_tokens - max number of tokens in summary
+            * sumdepth - max number of stages
+        Output:
+            * summary - summary (trimmed to max_tokens if it does not fit after sumdepth stages)
+            * token_usage - tokens used by all stages (dict - {"prompt": int, "completion": int})
+        '''
+        total_usage = {"prompt": 0, "completion": 0}
+        # every chunk should fit into the model context together with the prompt and the summary
+        chunk_tokens = max(int(self.max_tokens * 0.8) - self.file_summary_tokens, 256)
+        semaphore = asyncio.Semaphore(self.summary_concurrency)
+
+        async def summarize(chunk):
+            async with semaphore:
+                return await self.text_engine.summary(chunk, size=self.file_summary_tokens)
+
+        parts = [text]
+        for depth in range(1, sumdepth + 1):
+            if await self.count_text_tokens('\n'.join(parts)) <= max_tokens:
+                break
+            # chunks are made from whole parts when it is possible, so summaries are not cut in the middle
+            chunks = await self.split_tokens(text, chunk_tokens) if depth == 1 else await self.group_parts(parts, chunk_tokens)
+            start = time.monotonic()
+            results = await asyncio.gather(*[summarize(chunk) for chunk in chunks])
+            stage_usage = {"prompt": 0, "completion": 0}
+            parts = []
+            for summary, token_usage in results:
+                stage_usage['prompt'] += int(token_usage['prompt'])
+                stage_usage['completion'] += int(token_usage['completion'])
+                if summary is not None:
+                    parts.append(summary)
+            total_usage['prompt'] += stage_usage['prompt']
+            total_usage['completion'] += stage_usage['completion']
+            logger.debug(f'Summary stage {depth}: {len(chunks)} chunks -> {len(parts)} summaries in {time.monotonic() - start:.2f}s, token usage: {stage_usage}')
+            if not parts:
+                return None, total_usage
+            if len(parts) == 1:
+                break
+        summary = '\n'.join(parts)
+        if await self.count_text_tokens(summary) > max_tokens:
+            summary = (await self.split_tokens(summary, max_tokens))[0]
+        return summary, total_usage
+
+    async def group_parts(self, parts, chunk_tokens) -> list:
+        '''
+        Join parts into chunks of at most `chunk_tokens` tokens (long parts are split)
+        '''
+        chunks, current, current_tokens = [], [], 0
+        counts = await self.text_engine.token_counter.encode(parts)
+        for part, tokens in zip(parts, counts):
+            if tokens > chunk_tokens:
+                chunks.extend(await self.split_tokens(part, chunk_tokens))
+                continue
+            if current and current_tokens + tokens > chunk_tokens:
+                chunks.append('\n'.join(current))
+                current, current_tokens = [], 0
+            current.append(part)
+            current_tokens += tokens
+        if current:
+            chunks.append('\n'.join(current))
+        return chunks
+
+    async def count_text_tokens(self, text) -> int:
+        '''
+        Number of tokens in text
+        '''
+        return (await self.text_engine.token_counter.encode([text]))[0]
+
     async def filechat(self, id=0, text='', sumdepth=3):
         '''
         Process file 
@@ -1107,29 +1261,18 @@ class ChatProc:
             # if text length is more than self.max_file_length then return message
             if len(text) > self.max_file_length:
                 return 'Text is too long. Please, send a shorter text.'
-            # if text is than self.max_tokens // 2, then make summary
-            maxlength = round(self.file_summary_tokens) * 4 - 32
-            if len(text) > maxlength:
-                # to do that we split text into chunks with length no more than maxlength and make summary for each chunk
-                # do that until we have summary with length no more than maxlength
-                depth = 0
-                chunklength = self.max_tokens * 4 - 80
-                while len(text) > maxlength:
-                    if depth == sumdepth:
-                        # cut text to maxlength and return
-                        text = text[:maxlength]
-                        break
-                    depth += 1
-                    chunks = [text[i:i+chunklength] for i in range(0, len(text), chunklength)]
-                    text = ''
-                    for chunk in chunks:
-                        text += await self.text_engine.summary(chunk, size=self.file_summary_tokens) + '\n'
+            # if text is longer than self.file_summary_tokens, then make summary
+            if await self.count_text_tokens(text) > self.file_summary_tokens:
+                text, token_usage = await self.summarize_text(text, self.file_summary_tokens, sumdepth=sumdepth)
+                await self.add_stats(id=id, prompt_tokens_used=token_usage['prompt'], completion_tokens_used=token_usage['completion'])
+                if text is None:
+                    return 'Sorry, I could not summarize the file. Please try again later.'
                 text = '# Summary from recieved file: #\n' + text
             else:
-                # if text is shorter than self.max_tokens // 2, then do not make summary
+                # if text is short, then do not make summary
                 text = '# Text from recieved file: #\n' + text
             # chat with GPT
-            response = self.chat(id=id, message=text)
+            response = await self.chat(id=id, message=text)
             return response
         except Exception as e:
             logger.exception('Could not process file for user: ' + str(id))
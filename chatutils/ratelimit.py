@@ -0,0 +1,138 @@
+# Description: In-memory sliding-window rate limiter for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-RateLimit")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import asyncio
+import time
+from collections import deque
+
+
+class RateLimiter:
+    '''
+    Sliding-window rate limiter
+    Every user has a deque of timestamps of messages within the window, expired timestamps
+    are evicted from the left (amortized O(1) per message).
+    Timestamps are kept in memory and saved to the store (`save_rates`) only periodically,
+    so limits survive restarts without touching disk on every message.
+    '''
+    def __init__(self, store, window, snapshot_interval=60.0):
+        self.store = store
+        self.window = window
+        self.snapshot_interval = max(float(snapshot_interval), 1.0)
+        self.events = {}
+        self.dirty = False
+        self.task = None
+        self.restore()
+
+    def restore(self) -> None:
+        '''
+        Restore timestamps from the last snapshot
+        '''
+        try:
+            since = time.time() - self.window
+            for user_id, timestamps in self.store.load_rates().items():
+                timestamps = deque(sorted(x for x in timestamps if x > since))
+                if timestamps:
+                    self.events[user_id] = timestamps
+            logger.debug(f'Restored rate limits of {len(self.events)} users')
+        except Exception as e:
+            logger.exception('Could not restore rate limits, starting with empty limits')
+
+    def evict(self, user_id, now):
+        '''
+        Drop timestamps that are out of the window, returns deque of the user
+        '''
+        timestamps = self.events.get(user_id)
+        if timestamps is None:
+            return None
+        since = now - self.window
+        while timestamps and timestamps[0] <= since:
+            timestamps.popleft()
+            self.dirty = True
+        return timestamps
+
+    def count(self, user_id, now=None) -> int:
+        '''
+        Number of messages of a user within the window
+        '''
+        timestamps = self.evict(user_id, now if now is not None else time.time())
+        return len(timestamps) if timestamps is not None else 0
+
+    def add(self, user_id, now=None) -> int:
+        '''
+        Register a message of a user, returns number of messages within the window
+        '''
+        now = now if now is not None else time.time()
+        timestamps = self.evict(user_id, now)
+        if timestamps is None:
+            timestamps = self.events[user_id] = deque()
+        timestamps.append(now)
+        self.dirty = True
+        return len(timestamps)
+
+    def snapshot(self) -> dict:
+        '''
+        Copy of timestamps of all users (users without messages within the window are dropped)
+        '''
+        now = time.time()
+        for user_id in list(self.events.keys()):
+            if not self.evict(user_id, now):
+                del self.events[user_id]
+        return {user_id: list(timestamps) for user_id, timestamps in self.events.items()}
+
+    async def save(self) -> None:
+        '''
+        Save snapshot to the store (in a thread)
+        '''
+        if not self.dirty:
+            return None
+        self.dirty = False
+        rates = self.snapshot()
+        try:
+            await asyncio.to_thread(self.store.save_rates, rates)
+            logger.debug(f'Saved rate limits of {len(rates)} users')
+        except Exception as e:
+            self.dirty = True
+            logger.exception('Could not save rate limits, will retry')
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.save()
+
+    async def start(self) -> None:
+        '''
+        Start periodic snapshots (must be called from the running event loop)
+        '''
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        '''
+        Stop periodic snapshots and save the last one
+        '''
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.save()
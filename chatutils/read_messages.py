@@ -1,6 +1,42 @@
 import pickle
+import sqlite3
+import os
 
-chats = pickle.load(open('../data/tech/chats.pickle', 'rb'))
+def read_chat_log(path):
+    '''
+    Replay per-user chat log (see AppendLogChatStore in storage.py)
+    '''
+    messages = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except Exception:
+                break
+            if record[0] == 'set':
+                messages = list(record[1])
+            elif record[0] == 'extend':
+                messages.extend(record[1])
+            elif record[0] == 'update':
+                messages[record[1]] = record[2]
+            elif record[0] == 'truncate':
+                del messages[record[1]:]
+    return messages
+
+# chat history is stored in SQLite database, as per-user logs (./data/tech/chats/<id>.log) or in a legacy pickle file
+db = '../data/tech/sirchatalot.db' if os.path.exists('../data/tech/sirchatalot.db') else None
+if db is not None:
+    conn = sqlite3.connect(f'file:{db}?mode=ro', uri=True)
+    chats = {}
+    for userid, message in conn.execute('SELECT user_id, message FROM messages ORDER BY user_id, position'):
+        chats.setdefault(userid, []).append(pickle.loads(message))
+elif os.path.exists('../data/tech/chats.pickle'):
+    chats = pickle.load(open('../data/tech/chats.pickle', 'rb'))
+else:
+    chats = {}
+    for filename in os.listdir('../data/tech/chats'):
+        if filename.endswith('.log'):
+            chats[filename[:-len('.log')]] = read_chat_log(os.path.join('../data/tech/chats', filename))
 
 print('\n')
 
@@ -35,7 +71,13 @@ for userid in chats.keys():
         print(text)
     print('****************', '\n')
 
-stats = pickle.load(open('../data/tech/stats.pickle', 'rb'))
+if db is not None:
+    stats = {}
+    for userid, key, value in conn.execute('SELECT user_id, key, value FROM stats'):
+        stats.setdefault(userid, {})[key] = value
+    conn.close()
+else:
+    stats = pickle.load(open('../data/tech/stats.pickle', 'rb'))
 
 total = 0
 rating = []
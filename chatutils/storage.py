@@ -0,0 +1,1217 @@
+# Description: Chat history storage backends for SirChatalot
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Storage")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import os
+import copy
+import pickle
+import asyncio
+import time
+import json
+import codecs
+import sqlite3
+import threading
+import contextlib
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+
+######## Base Chat Store ########
+
+def snapshot(messages, changed=None) -> list:
+    '''
+    Messages to write: copies of messages that were changed in place, other messages as they are
+    '''
+    if not changed:
+        return messages
+    return [changed.get(index, message) for index, message in enumerate(messages)]
+
+
+class ChatStore:
+    '''
+    Base class for chat history storage backends
+    Chat history is a dict {user_id: [message, ...]} kept in memory by ChatProc,
+    backend is notified about every change so it can persist only what was changed
+    Statistics, saved sessions, rate limits and files metadata are stored in files by default
+    '''
+    stats_location = "./data/tech/stats.pickle"
+    sessions_location = "./data/chats"
+    rates_location = "./data/tech/ratelimit.pickle"
+    files_location = "./data/files/files.json"
+    # backend can write metadata of one file (upsert_file/delete_files) instead of the whole catalog (save_files)
+    incremental_files = False
+
+    def load_all(self) -> dict:
+        '''
+        Load chat history of all users
+        '''
+        raise NotImplementedError
+
+    def load(self, id):
+        '''
+        Load chat history of one user (None if there is no history)
+        '''
+        raise NotImplementedError
+
+    def save(self, id, messages, changed=None) -> None:
+        '''
+        Persist the whole chat of a user (only the difference is written if possible)
+        Input:
+            * messages - messages of the chat (compared with persisted ones by identity)
+            * changed - {index: copy of message} for messages that were changed in place
+              (caption, system message, etc.), copies are written instead of the messages
+        '''
+        raise NotImplementedError
+
+    def delete(self, id) -> None:
+        '''
+        Delete chat history of a user
+        '''
+        raise NotImplementedError
+
+    def sync(self) -> None:
+        '''
+        Force written data to disk (fsync)
+        '''
+        pass
+
+    def forget(self, id) -> None:
+        '''
+        Drop in-memory state kept for a user (chat was evicted from the cache)
+        '''
+        pass
+
+    def transaction(self):
+        '''
+        Group several writes into one batch (if supported by the backend)
+        '''
+        return contextlib.nullcontext()
+
+    ######## Statistics ########
+
+    def load_stats(self) -> dict:
+        '''
+        Load statistics of all users
+        '''
+        try:
+            with open(self.stats_location, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.debug(f'Could not load file: {self.stats_location}. Created new file.')
+            self.save_stats({})
+            return {}
+
+    def save_stats(self, stats, sync=False) -> None:
+        '''
+        Save statistics of all users (file is replaced atomically)
+        '''
+        tmp_location = self.stats_location + '.tmp'
+        with open(tmp_location, "wb") as f:
+            pickle.dump(stats, f)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_location, self.stats_location)
+
+    ######## Saved sessions ########
+
+    def session_path(self, id) -> str:
+        return os.path.join(self.sessions_location, f'{id}.pickle')
+
+    def load_sessions(self, id) -> dict:
+        try:
+            with open(self.session_path(id), "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            return {}
+
+    def list_sessions(self, id) -> list:
+        '''
+        Get names of saved sessions of a user
+        '''
+        return list(self.load_sessions(id).keys())
+
+    def load_session(self, id, name):
+        '''
+        Get messages of a saved session (None if there is no such session)
+        '''
+        return self.load_sessions(id).get(name)
+
+    def save_session(self, id, name, messages) -> None:
+        '''
+        Save messages as a named session of a user
+        '''
+        sessions = self.load_sessions(id)
+        sessions[name] = messages
+        with open(self.session_path(id), "wb") as f:
+            pickle.dump(sessions, f)
+
+    def delete_session(self, id, name) -> None:
+        '''
+        Delete a saved session of a user
+        '''
+        sessions = self.load_sessions(id)
+        del sessions[name]
+        with open(self.session_path(id), "wb") as f:
+            pickle.dump(sessions, f)
+
+    def all_messages(self):
+        '''
+        Iterate over messages of all stored chats and saved sessions (e.g. to find referenced images)
+        Chats are not kept in memory by the store after that
+        '''
+        for id, messages in self.load_all().items():
+            self.forget(id)
+            yield from messages
+        if not os.path.isdir(self.sessions_location):
+            return None
+        for filename in os.listdir(self.sessions_location):
+            if filename.endswith('.pickle'):
+                for messages in self.load_sessions(filename[:-len('.pickle')]).values():
+                    yield from messages
+
+    ######## Rate limits ########
+
+    def load_rates(self) -> dict:
+        '''
+        Load snapshot of rate limits {user_id: [timestamp, ...]}
+        '''
+        try:
+            if os.path.exists(self.rates_location):
+                with open(self.rates_location, "rb") as f:
+                    return pickle.load(f)
+            logger.info(f'No {self.rates_location} file found. Creating a new one.')
+        except Exception as e:
+            logger.error(f'Error while opening {self.rates_location}. Error: {e}')
+        self.save_rates({})
+        return {}
+
+    def save_rates(self, rates) -> None:
+        '''
+        Save snapshot of rate limits (see RateLimiter)
+        '''
+        with open(self.rates_location, "wb") as f:
+            pickle.dump(rates, f)
+
+    ######## Files metadata ########
+
+    def load_files(self) -> dict:
+        '''
+        Load metadata of processed files {owner: {filename: {"summary": str, "processed": bool}}}
+        Owner is user id (as string) or "common"
+        '''
+        if not os.path.exists(self.files_location):
+            return {}
+        with codecs.open(self.files_location, 'r', 'utf-8') as f:
+            return json.load(f)
+
+    def save_files(self, files) -> None:
+        '''
+        Save metadata of processed files (atomically)
+        '''
+        os.makedirs(os.path.dirname(self.files_location), exist_ok=True)
+        tmp_location = f'{self.files_location}.{os.getpid()}.tmp'
+        with codecs.open(tmp_location, 'w', 'utf-8') as f:
+            json.dump(files, f, ensure_ascii=False)
+        os.replace(tmp_location, self.files_location)
+
+    def upsert_file(self, owner, filename, metadata) -> None:
+        '''
+        Add or replace metadata of a file
+        '''
+        files = self.load_files()
+        if str(owner) not in files:
+            files[str(owner)] = {}
+        files[str(owner)][filename] = metadata
+        self.save_files(files)
+
+    def delete_files(self, owner) -> None:
+        '''
+        Delete metadata of all files of an owner
+        '''
+        files = self.load_files()
+        if str(owner) in files:
+            del files[str(owner)]
+            self.save_files(files)
+
+    def close(self) -> None:
+        '''
+        Release resources used by the backend
+        '''
+        pass
+
+
+######## Pickle Chat Store (legacy) ########
+
+class PickleChatStore(ChatStore):
+    '''
+    Legacy backend: the whole dict is dumped to a single pickle file on every change
+    '''
+    def __init__(self, location="./data/tech/chats.pickle"):
+        self.location = location
+        self.chats = None
+        logger.info(f'Pickle chat store is used ({self.location})')
+
+    def dump(self) -> None:
+        with open(self.location, "wb") as f:
+            pickle.dump(self.chats, f)
+
+    def sync(self) -> None:
+        if os.path.exists(self.location):
+            fd = os.open(self.location, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def load_all(self) -> dict:
+        try:
+            with open(self.location, "rb") as f:
+                self.chats = pickle.load(f)
+        except Exception as e:
+            self.chats = {}
+            self.dump()
+            logger.debug(f'Could not load file: {self.location}. Created new file.')
+        return self.chats
+
+    def load(self, id):
+        if self.chats is None:
+            self.load_all()
+        return self.chats.get(id)
+
+    def save(self, id, messages, changed=None) -> None:
+        if self.chats is None:
+            self.load_all()
+        self.chats[id] = snapshot(messages, changed)
+        self.dump()
+
+    def delete(self, id) -> None:
+        if self.chats is None:
+            self.load_all()
+        if id in self.chats:
+            del self.chats[id]
+        self.dump()
+
+
+######## Append-only Log Chat Store ########
+
+class AppendLogChatStore(ChatStore):
+    '''
+    Every user has its own append-only log file with pickled records:
+        * ('set', messages) - whole chat (always the first record after compaction)
+        * ('extend', [message, ...]) - messages added to the end of the chat
+        * ('update', index, message) - message changed in place
+        * ('truncate', length) - chat was cut to the given length
+    Only the delta is written for every change, the log is compacted to a single 'set'
+    record after `compact_every` records.
+    '''
+    def __init__(self, location="./data/tech/chats", compact_every=100, legacy_location="./data/tech/chats.pickle"):
+        self.location = location
+        self.compact_every = max(int(compact_every), 1)
+        os.makedirs(self.location, exist_ok=True)
+        # references to persisted messages (to find the delta) and number of records in every log
+        self.persisted = {}
+        self.records = {}
+        # logs that were written after the last sync
+        self.unsynced = set()
+        self.migrate(legacy_location)
+        logger.info(f'Append-only log chat store is used ({self.location}, compaction every {self.compact_every} records)')
+
+    def path(self, id) -> str:
+        return os.path.join(self.location, f'{id}.log')
+
+    def migrate(self, legacy_location) -> None:
+        '''
+        One-shot migration from the legacy chats.pickle file
+        Legacy file is renamed to *.migrated after all chats were written
+        '''
+        if legacy_location is None or not os.path.exists(legacy_location):
+            return None
+        try:
+            with open(legacy_location, "rb") as f:
+                chats = pickle.load(f)
+            for id, messages in chats.items():
+                if messages is None:
+                    continue
+                self.compact(id, messages)
+            os.replace(legacy_location, legacy_location + '.migrated')
+            logger.info(f'Migrated chat history of {len(chats)} users from {legacy_location}')
+        except Exception as e:
+            logger.exception(f'Could not migrate chat history from {legacy_location}')
+
+    def write(self, id, record) -> None:
+        with open(self.path(id), "ab") as f:
+            pickle.dump(record, f)
+        self.records[id] = self.records.get(id, 0) + 1
+        self.unsynced.add(id)
+
+    def sync(self) -> None:
+        for id in list(self.unsynced):
+            if not os.path.exists(self.path(id)):
+                continue
+            fd = os.open(self.path(id), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.unsynced.clear()
+
+    def compact(self, id, messages, changed=None) -> None:
+        '''
+        Rewrite the log of a user with a single 'set' record
+        '''
+        tmp_path = self.path(id) + '.tmp'
+        with open(tmp_path, "wb") as f:
+            pickle.dump(('set', snapshot(messages, changed)), f)
+        os.replace(tmp_path, self.path(id))
+        self.persisted[id] = list(messages)
+        self.records[id] = 1
+        self.unsynced.add(id)
+
+    def read(self, id):
+        '''
+        Replay the log of a user
+        Returns messages and flag that the log has a broken tail (e.g. after a crash)
+        '''
+        messages, records, broken = None, 0, False
+        with open(self.path(id), "rb") as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    logger.warning(f'Broken record in chat log of user {id} after {records} records: {e}')
+                    broken = True
+                    break
+                records += 1
+                op = record[0]
+                if op == 'set':
+                    messages = list(record[1])
+                elif op == 'extend':
+                    messages.extend(record[1])
+                elif op == 'update':
+                    messages[record[1]] = record[2]
+                elif op == 'truncate':
+                    del messages[record[1]:]
+        self.records[id] = records
+        return messages, broken
+
+    def load(self, id):
+        if not os.path.exists(self.path(id)):
+            return None
+        try:
+            messages, broken = self.read(id)
+            if messages is None:
+                return None
+            if broken or self.records[id] >= self.compact_every:
+                self.compact(id, messages)
+            self.persisted[id] = list(messages)
+            return messages
+        except Exception as e:
+            logger.exception(f'Could not load chat history of user {id}')
+            return None
+
+    def load_all(self) -> dict:
+        chats = {}
+        for filename in os.listdir(self.location):
+            if not filename.endswith('.log'):
+                continue
+            name = filename[:-len('.log')]
+            id = int(name) if name.lstrip('-').isdigit() else name
+            messages = self.load(id)
+            if messages is not None:
+                chats[id] = messages
+        logger.debug(f'Loaded chat history of {len(chats)} users')
+        return chats
+
+    def save(self, id, messages, changed=None) -> None:
+        changed = changed or {}
+        persisted = self.persisted.get(id)
+        if persisted is None:
+            self.compact(id, messages, changed)
+            return None
+        # find the longest common prefix (messages are compared by identity, not by value)
+        common = 0
+        for old, new in zip(persisted, messages):
+            if old is not new:
+                break
+            common += 1
+        if common < len(persisted) and common < len(messages) // 2:
+            # most of the chat was changed (trimmed, summarized) - it is cheaper to rewrite it
+            self.compact(id, messages, changed)
+            return None
+        for index in sorted(changed):
+            if index < common:
+                self.write(id, ('update', index, changed[index]))
+        if common < len(persisted):
+            self.write(id, ('truncate', common))
+            del persisted[common:]
+        if common < len(messages):
+            self.write(id, ('extend', snapshot(messages, changed)[common:]))
+            persisted.extend(messages[common:])
+        self.check_compaction(id, changed)
+
+    def delete(self, id) -> None:
+        if os.path.exists(self.path(id)):
+            os.remove(self.path(id))
+        self.persisted.pop(id, None)
+        self.records.pop(id, None)
+        self.unsynced.discard(id)
+
+    def forget(self, id) -> None:
+        self.persisted.pop(id, None)
+        self.records.pop(id, None)
+
+    def check_compaction(self, id, changed=None) -> None:
+        if self.records.get(id, 0) >= self.compact_every:
+            logger.debug(f'Compacting chat log of user {id} ({self.records[id]} records)')
+            self.compact(id, self.persisted[id], changed)
+
+
+######## SQLite Chat Store ########
+
+class SQLiteChatStore(ChatStore):
+    '''
+    Single SQLite database (WAL mode) for chats, statistics, saved sessions, rate limits and files metadata
+    Every message is a separate row, so only changed messages are written.
+    The database is meant to be used by one bot process: chats, statistics and files metadata are cached
+    in memory (ChatCache, WriteBehind, FileCatalog) and are not re-read if another process changes them.
+    '''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS messages (
+            user_id NOT NULL,
+            position INTEGER NOT NULL,
+            message BLOB NOT NULL,
+            PRIMARY KEY (user_id, position)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS stats (
+            user_id NOT NULL,
+            key TEXT NOT NULL,
+            value,
+            PRIMARY KEY (user_id, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id NOT NULL,
+            name TEXT NOT NULL,
+            messages BLOB NOT NULL,
+            PRIMARY KEY (user_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS rate_events (
+            user_id NOT NULL,
+            ts REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS rate_events_user_ts ON rate_events (user_id, ts);
+        CREATE TABLE IF NOT EXISTS files (
+            owner TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            metadata TEXT NOT NULL,
+            PRIMARY KEY (owner, filename)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value
+        );
+    '''
+
+    def __init__(self, location="./data/tech/sirchatalot.db", busy_timeout=5000):
+        self.location = location
+        # connection is shared between the event loop and write-behind thread
+        self.conn = sqlite3.connect(self.location, timeout=busy_timeout / 1000,
+                                    isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(f'PRAGMA busy_timeout={int(busy_timeout)}')
+        self.conn.executescript(self.schema)
+        self.lock = threading.RLock()
+        self.depth = 0
+        # references to persisted messages (to find the delta) and persisted statistics
+        self.persisted = {}
+        self.persisted_stats = {}
+        self.migrate()
+        logger.info(f'SQLite chat store is used ({self.location})')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Group writes into one transaction (nested calls join the outer transaction)
+        '''
+        with self.lock:
+            if self.depth == 0:
+                self.conn.execute('BEGIN IMMEDIATE')
+            self.depth += 1
+            try:
+                yield self.conn
+            except Exception:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.conn.execute('ROLLBACK')
+                raise
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.conn.execute('COMMIT')
+
+    def query(self, sql, params=()) -> list:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def sync(self) -> None:
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+    ######## Migration ########
+
+    def migrate(self) -> None:
+        '''
+        One-shot migration from pickle files, chat logs and files.json
+        Legacy files are left in place, migration is marked as done in the database
+        '''
+        if self.query("SELECT value FROM meta WHERE key = 'migrated'"):
+            return None
+        try:
+            with self.transaction():
+                chats = {}
+                if os.path.exists('./data/tech/chats.pickle'):
+                    with open('./data/tech/chats.pickle', "rb") as f:
+                        chats = pickle.load(f)
+                elif os.path.exists('./data/tech/chats'):
+                    chats = AppendLogChatStore(legacy_location=None).load_all()
+                for id, messages in chats.items():
+                    if messages:
+                        self.save(id, messages)
+                if os.path.exists(self.stats_location):
+                    self.save_stats(ChatStore.load_stats(self))
+                if os.path.exists(self.rates_location):
+                    self.save_rates(ChatStore.load_rates(self))
+                if os.path.exists(self.sessions_location):
+                    for filename in os.listdir(self.sessions_location):
+                        if not filename.endswith('.pickle'):
+                            continue
+                        name = filename[:-len('.pickle')]
+                        id = int(name) if name.lstrip('-').isdigit() else name
+                        for session, messages in ChatStore.load_sessions(self, id).items():
+                            self.save_session(id, session, messages)
+                for owner, files in ChatStore.load_files(self).items():
+                    for filename, metadata in files.items():
+                        self.upsert_file(owner, filename, metadata)
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)", (time.time(),))
+            logger.info(f'Migrated chat history of {len(chats)} users, statistics, sessions, rate limits and files to {self.location}')
+        except Exception as e:
+            logger.exception(f'Could not migrate legacy data to {self.location}')
+
+    ######## Chats ########
+
+    def load(self, id):
+        rows = self.query('SELECT message FROM messages WHERE user_id = ? ORDER BY position', (id,))
+        if not rows:
+            return None
+        messages = [pickle.loads(row[0]) for row in rows]
+        self.persisted[id] = list(messages)
+        return messages
+
+    def load_all(self) -> dict:
+        chats = {}
+        for id, message in self.query('SELECT user_id, message FROM messages ORDER BY user_id, position'):
+            chats.setdefault(id, []).append(pickle.loads(message))
+        self.persisted = {id: list(messages) for id, messages in chats.items()}
+        logger.debug(f'Loaded chat history of {len(chats)} users')
+        return chats
+
+    def save(self, id, messages, changed=None) -> None:
+        changed = changed or {}
+        persisted = self.persisted.get(id, [])
+        # find the longest common prefix (messages are compared by identity, not by value)
+        common = 0
+        for old, new in zip(persisted, messages):
+            if old is not new:
+                break
+            common += 1
+        updated = [index for index in sorted(changed) if index < common]
+        if common == len(persisted) == len(messages) and not updated:
+            return None
+        with self.transaction() as conn:
+            conn.executemany('UPDATE messages SET message = ? WHERE user_id = ? AND position = ?',
+                             [(pickle.dumps(changed[index]), id, index) for index in updated])
+            if common < len(persisted) or id not in self.persisted:
+                conn.execute('DELETE FROM messages WHERE user_id = ? AND position >= ?', (id, common))
+            conn.executemany('INSERT INTO messages (user_id, position, message) VALUES (?, ?, ?)',
+                             [(id, position, pickle.dumps(changed.get(position, messages[position]))) for position in range(common, len(messages))])
+        self.persisted[id] = list(messages)
+
+    def delete(self, id) -> None:
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM messages WHERE user_id = ?', (id,))
+        self.persisted.pop(id, None)
+
+    def forget(self, id) -> None:
+        self.persisted.pop(id, None)
+
+    ######## Statistics ########
+
+    def load_stats(self) -> dict:
+        stats = {}
+        for id, key, value in self.query('SELECT user_id, key, value FROM stats'):
+            stats.setdefault(id, {})[key] = value
+        self.persisted_stats = {(id, key): value for id, values in stats.items() for key, value in values.items()}
+        return stats
+
+    def save_stats(self, stats, sync=False) -> None:
+        '''
+        Only changed counters are written
+        '''
+        changed = []
+        for id, values in stats.items():
+            for key, value in values.items():
+                if (id, key) not in self.persisted_stats or self.persisted_stats[(id, key)] != value:
+                    changed.append((id, key, value))
+        if not changed:
+            return None
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO stats (user_id, key, value) VALUES (?, ?, ?)', changed)
+        for id, key, value in changed:
+            self.persisted_stats[(id, key)] = value
+
+    ######## Saved sessions ########
+
+    def list_sessions(self, id) -> list:
+        return [row[0] for row in self.query('SELECT name FROM sessions WHERE user_id = ? ORDER BY rowid', (id,))]
+
+    def load_session(self, id, name):
+        rows = self.query('SELECT messages FROM sessions WHERE user_id = ? AND name = ?', (id, name))
+        return pickle.loads(rows[0][0]) if rows else None
+
+    def save_session(self, id, name, messages) -> None:
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO sessions (user_id, name, messages) VALUES (?, ?, ?) '
+                         'ON CONFLICT (user_id, name) DO UPDATE SET messages = excluded.messages',
+                         (id, name, pickle.dumps(messages)))
+
+    def delete_session(self, id, name) -> None:
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM sessions WHERE user_id = ? AND name = ?', (id, name))
+
+    def all_messages(self):
+        for (message,) in self.query('SELECT message FROM messages'):
+            yield pickle.loads(message)
+        for (messages,) in self.query('SELECT messages FROM sessions'):
+            yield from pickle.loads(messages)
+
+    ######## Rate limits ########
+
+    def load_rates(self) -> dict:
+        rates = {}
+        for user_id, ts in self.query('SELECT user_id, ts FROM rate_events ORDER BY user_id, ts'):
+            rates.setdefault(user_id, []).append(ts)
+        return rates
+
+    def save_rates(self, rates) -> None:
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM rate_events')
+            conn.executemany('INSERT INTO rate_events (user_id, ts) VALUES (?, ?)',
+                             [(user_id, ts) for user_id, events in rates.items() for ts in events])
+
+    ######## Files metadata ########
+
+    incremental_files = True
+
+    def load_files(self) -> dict:
+        files = {}
+        for owner, filename, metadata in self.query('SELECT owner, filename, metadata FROM files'):
+            files.setdefault(owner, {})[filename] = json.loads(metadata)
+        return files
+
+    def upsert_file(self, owner, filename, metadata) -> None:
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO files (owner, filename, metadata) VALUES (?, ?, ?)',
+                         (str(owner), filename, json.dumps(metadata, ensure_ascii=False)))
+
+    def delete_files(self, owner) -> None:
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM files WHERE owner = ?', (str(owner),))
+
+
+######## Write-behind persistence ########
+
+class WriteBehind:
+    '''
+    Write-behind layer on top of a chat store
+    Changes only mark users (and statistics) dirty, a background task flushes them
+    every `interval` seconds or as soon as `max_dirty` users are dirty.
+    Writing is done in a thread, so disk I/O does not block the event loop.
+    If the background task is not started, changes are written immediately.
+    '''
+    def __init__(self, store, stats, interval=2.0, max_dirty=50):
+        self.store = store
+        self.stats = stats
+        self.interval = max(float(interval), 0.1)
+        self.max_dirty = max(int(max_dirty), 1)
+        # {id: (messages or None if chat was deleted, set of indexes of messages changed in place)}
+        self.dirty = {}
+        # snapshot that is being written right now
+        self.flushing = {}
+        self.stats_dirty = False
+        # called with id of user and index of message changed in place after chat was changed (see ChatCache)
+        self.on_change = None
+        self.task = None
+        self.wake = None
+        self.lock = None
+        self.flushes, self.writes = 0, 0
+
+    def chat_changed(self, id, messages, index=None) -> None:
+        '''
+        Mark chat of a user dirty
+        Input:
+            * id - id of user
+            * messages - current messages of user
+            * index - index of message that was changed in place (None if messages were only added or replaced)
+        '''
+        _, indexes = self.dirty.get(id, (None, set()))
+        if index is not None:
+            index = index if index >= 0 else len(messages) + index
+            indexes.add(index)
+        self.dirty[id] = (messages, indexes)
+        if self.on_change is not None:
+            self.on_change(id, index)
+        self.changed()
+
+    def chat_deleted(self, id) -> None:
+        '''
+        Mark chat of a user deleted
+        '''
+        self.dirty[id] = (None, set())
+        self.changed()
+
+    def stats_changed(self) -> None:
+        '''
+        Mark statistics dirty
+        '''
+        self.stats_dirty = True
+        self.changed()
+
+    def pending(self, id):
+        '''
+        Check if chat of a user was changed but not written yet
+        Returns flag and messages that will be written (None if chat was deleted)
+        '''
+        if id in self.dirty:
+            return True, self.dirty[id][0]
+        if id in self.flushing:
+            return True, self.flushing[id][0]
+        return False, None
+
+    def changed(self) -> None:
+        if self.task is None:
+            # background task is not running - write through
+            dirty, stats = self.take()
+            self.write(dirty, stats, False)
+        elif len(self.dirty) >= self.max_dirty:
+            self.wake.set()
+
+    def take(self):
+        '''
+        Take a snapshot of dirty data (must be called from the event loop)
+        Messages that were changed in place (e.g. system message) are copied, so they can be changed again
+        while the snapshot is written. Other messages are kept as they are: stores find new messages by identity.
+        '''
+        dirty = {}
+        for id, (messages, indexes) in self.dirty.items():
+            if messages is None:
+                dirty[id] = (None, {})
+                continue
+            dirty[id] = (list(messages), {index: copy.copy(messages[index]) for index in indexes if index < len(messages)})
+        stats = None
+        if self.stats_dirty:
+            stats = {id: dict(values) for id, values in self.stats.items()}
+        self.dirty = {}
+        self.stats_dirty = False
+        return dirty, stats
+
+    def write(self, dirty, stats, sync) -> None:
+        '''
+        Write snapshot to the store (runs in a thread)
+        '''
+        with self.store.transaction():
+            for id, (messages, changed) in dirty.items():
+                if messages is None:
+                    self.store.delete(id)
+                    continue
+                self.store.save(id, messages, changed)
+                self.writes += 1
+            if stats is not None:
+                self.store.save_stats(stats, sync=sync)
+        if sync:
+            self.store.sync()
+
+    async def flush(self, sync=False) -> None:
+        '''
+        Flush all dirty data to the store
+        '''
+        if self.lock is None:
+            dirty, stats = self.take()
+            self.write(dirty, stats, sync)
+            return None
+        async with self.lock:
+            dirty, stats = self.take()
+            if not dirty and stats is None and not sync:
+                return None
+            start = time.time()
+            self.flushing = dirty
+            try:
+                await asyncio.to_thread(self.write, dirty, stats, sync)
+                self.flushes += 1
+                logger.debug(f'Flushed {len(dirty)} chats{" and statistics" if stats is not None else ""} in {round(time.time() - start, 3)}s')
+            except Exception as e:
+                logger.exception('Could not flush chats and statistics, will retry')
+                # put data back, newer changes have priority
+                for id, (messages, changed) in dirty.items():
+                    if id not in self.dirty:
+                        self.dirty[id] = (messages, set(changed))
+                    else:
+                        self.dirty[id][1].update(changed)
+                if stats is not None:
+                    self.stats_dirty = True
+            finally:
+                self.flushing = {}
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            await self.flush()
+
+    async def start(self) -> None:
+        '''
+        Start background flushing (must be called from the running event loop)
+        '''
+        if self.task is not None:
+            return None
+        self.wake = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = asyncio.create_task(self.run())
+        logger.info(f'Write-behind persistence is started (interval: {self.interval}s, max dirty users: {self.max_dirty})')
+
+    async def stop(self) -> None:
+        '''
+        Stop background flushing, drain all dirty data and fsync it
+        '''
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.flush(sync=True)
+        self.task = None
+        self.lock = None
+        logger.info(f'Write-behind persistence is stopped (flushes: {self.flushes}, chat writes: {self.writes})')
+
+
+######## Chat cache ########
+
+def chat_size(value) -> int:
+    '''
+    Approximate size of chat in memory (length of all strings, images in base64 dominate)
+    '''
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(chat_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(chat_size(v) for v in value)
+    return 8
+
+
+class ChatCache(MutableMapping):
+    '''
+    Bounded LRU cache of chats {user_id: [message, ...]} on top of a chat store
+    Chats are loaded from the store on first access and evicted in LRU order when there are
+    more than `max_users` chats or they take more than `max_bytes` (0 - no limit).
+    Chats with changes that were not written yet are never evicted.
+    Iteration and len() cover only cached chats.
+    Use `await has(id)` in async code, so cache misses are loaded in a thread.
+    Hits and misses are counted by the check of residency (`has`, `in`), not by following access.
+    Size of a chat is kept per message, only added and changed messages are measured.
+    '''
+    def __init__(self, store, write_behind, max_users=1000, max_bytes=0):
+        self.store = store
+        self.write_behind = write_behind
+        self.write_behind.on_change = self.resize
+        self.max_users = max(int(max_users), 0)
+        self.max_bytes = max(int(max_bytes), 0)
+        self.entries = OrderedDict()
+        self.sizes = {}
+        # sizes of messages and the first and the last measured message of every chat
+        self.message_sizes = {}
+        self.ends = {}
+        self.total = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def load(self, id):
+        pending, messages = self.write_behind.pending(id)
+        if not pending:
+            messages = self.store.load(id)
+        return messages
+
+    async def has(self, id) -> bool:
+        '''
+        Check if a user has a chat, loading it from the store in a thread on a cache miss
+        (the event loop is not blocked by reading and parsing the chat)
+        '''
+        if id in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(id)
+            return True
+        self.misses += 1
+        pending, messages = self.write_behind.pending(id)
+        if not pending:
+            messages = await asyncio.to_thread(self.store.load, id)
+        # chat could be set while it was loaded, it is newer then
+        if id in self.entries:
+            return True
+        if messages is None:
+            return False
+        self.entries[id] = messages
+        self.resize(id)
+        return True
+
+    def __getitem__(self, id):
+        if id in self.entries:
+            self.entries.move_to_end(id)
+            return self.entries[id]
+        self.misses += 1
+        messages = self.load(id)
+        if messages is None:
+            raise KeyError(id)
+        self.entries[id] = messages
+        self.resize(id)
+        return messages
+
+    def __contains__(self, id) -> bool:
+        if id in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(id)
+            return True
+        try:
+            self[id]
+            return True
+        except KeyError:
+            return False
+
+    def __setitem__(self, id, messages) -> None:
+        self.entries[id] = messages
+        self.entries.move_to_end(id)
+        self.resize(id)
+
+    def __delitem__(self, id) -> None:
+        del self.entries[id]
+        self.total -= self.sizes.pop(id, 0)
+        self.message_sizes.pop(id, None)
+        self.ends.pop(id, None)
+
+    def __iter__(self):
+        return iter(list(self.entries.keys()))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def resize(self, id, index=None) -> None:
+        '''
+        Update size of a chat (called after every change) and evict chats if needed
+        Input:
+            * id - id of user
+            * index - index of message that was changed in place (None if messages were only added or replaced)
+        '''
+        if id not in self.entries:
+            return None
+        if self.max_bytes:
+            messages = self.entries[id]
+            sizes = self.message_sizes.get(id)
+            first, last = self.ends.get(id, (None, None))
+            count = len(sizes) if sizes else 0
+            size = self.sizes.get(id, 0)
+            if count and count <= len(messages) and messages[0] is first and messages[count - 1] is last:
+                # messages were added to the end (and one of them could be changed in place)
+                if index is not None and index < count:
+                    changed = chat_size(messages[index])
+                    size += changed - sizes[index]
+                    sizes[index] = changed
+                for message in messages[count:]:
+                    sizes.append(chat_size(message))
+                    size += sizes[-1]
+            else:
+                # chat was replaced (trimmed, summarized, loaded) - measure all messages
+                sizes = [chat_size(message) for message in messages]
+                size = sum(sizes)
+            self.message_sizes[id] = sizes
+            self.ends[id] = (messages[0], messages[-1]) if messages else (None, None)
+            self.total += size - self.sizes.get(id, 0)
+            self.sizes[id] = size
+        self.evict()
+
+    def over_budget(self) -> bool:
+        if self.max_users and len(self.entries) > self.max_users:
+            return True
+        if self.max_bytes and self.total > self.max_bytes:
+            return True
+        return False
+
+    def evict(self) -> None:
+        '''
+        Evict least recently used chats until the cache fits the budget
+        The most recently used chat is always kept
+        '''
+        if not self.over_budget():
+            return None
+        for id in list(self.entries.keys())[:-1]:
+            if not self.over_budget():
+                break
+            if self.write_behind.pending(id)[0]:
+                continue
+            del self[id]
+            self.store.forget(id)
+            self.evictions += 1
+            logger.debug(f'Evicted chat of user {id} from cache')
+
+    def info(self) -> dict:
+        '''
+        Cache statistics
+        '''
+        return {
+            'users': len(self.entries),
+            'bytes': self.total,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+######## File catalog ########
+
+class FileCatalog:
+    '''
+    Metadata of processed files {owner: {filename: metadata}} kept in memory on top of a chat store
+    Metadata is loaded from the store once, changes are applied in memory and persisted in a thread
+    one at a time: the whole catalog is saved (save_files) or, if the backend supports it,
+    only the changed file (upsert_file/delete_files).
+    Text rendered from the catalog for a user (`render(files, user_id)`) is cached until
+    files of the user or common files are changed.
+    '''
+    def __init__(self, store, render=None):
+        self.store = store
+        self.render = render
+        self.files = None
+        self.lock = None
+        self.fragments = {}
+
+    def load(self) -> dict:
+        '''
+        All metadata (loaded from the store on the first call), should not be changed by caller
+        '''
+        if self.files is None:
+            self.files = self.store.load_files()
+            logger.debug(f'File catalog was loaded: {sum(len(files) for files in self.files.values())} files')
+        return self.files
+
+    def get(self, owner) -> dict:
+        '''
+        Metadata of files of an owner (user id or "common")
+        '''
+        return self.load().get(str(owner), {})
+
+    def fragment(self, user_id):
+        '''
+        Rendered text for a user (cached)
+        '''
+        key = str(user_id)
+        fragment = self.fragments.get(key)
+        if fragment is None:
+            fragment = self.render(self.load(), user_id)
+            self.fragments[key] = fragment
+        return fragment
+
+    def changed(self, owner) -> None:
+        '''
+        Drop rendered text that depends on files of an owner
+        '''
+        if owner == 'common':
+            self.fragments.clear()
+        else:
+            self.fragments.pop(owner, None)
+
+    async def persist(self, write, *args) -> None:
+        '''
+        Run a write to the store in a thread, writes are done in the order of changes
+        '''
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.store.incremental_files:
+                await asyncio.to_thread(write, *args)
+            else:
+                # the latest catalog is saved, dicts are replaced on change and never changed in place
+                await asyncio.to_thread(self.store.save_files, self.files)
+
+    async def upsert(self, owner, filename, metadata) -> None:
+        '''
+        Add or replace metadata of a file
+        '''
+        owner = str(owner)
+        files = dict(self.load())
+        files[owner] = dict(files.get(owner, {}), **{filename: metadata})
+        self.files = files
+        self.changed(owner)
+        await self.persist(self.store.upsert_file, owner, filename, metadata)
+
+    async def delete(self, owner) -> None:
+        '''
+        Delete metadata of all files of an owner
+        '''
+        owner = str(owner)
+        files = dict(self.load())
+        files.pop(owner, None)
+        self.files = files
+        self.changed(owner)
+        await self.persist(self.store.delete_files, owner)
+
+
+def get_chat_store():
+    '''
+    Get chat store from config ([Storage] section)
+    '''
+    store = config.get("Storage", "ChatStore", fallback="log").lower()
+    if store == "pickle":
+        return PickleChatStore()
+    elif store == "log":
+        compact_every = config.getint("Storage", "CompactEvery", fallback=100)
+        return AppendLogChatStore(compact_every=compact_every)
+    elif store == "sqlite":
+        location = config.get("Storage", "Database", fallback="./data/tech/sirchatalot.db")
+        return SQLiteChatStore(location=location)
+    else:
+        logger.error(f"Unknown chat store: {store}")
+        raise ValueError(f"Unknown chat store: {store}")
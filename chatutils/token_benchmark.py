@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+'''
+Benchmark of token counting: event loop lag while 50 users with long conversations are chatting
+Compares:
+    - before: every message is encoded on every turn inside the event loop (sync path)
+    - after (cold): TokenCounter with empty cache (messages are encoded in token_executor)
+    - after (warm): TokenCounter with cache (only a new message is encoded on every turn)
+tiktoken `cl100k_base` is used if it can be loaded, otherwise (offline) a stub encoding is used:
+it burns CPU in zlib, which releases the GIL like tiktoken does, and returns ~4 characters per token.
+Run from the root directory of the bot:
+    python -m chatutils.token_benchmark
+'''
+import asyncio
+import random
+import time
+import statistics
+import zlib
+import tiktoken
+
+from chatutils.engines import TokenCounter
+
+USERS = 50
+MESSAGES = 200
+MESSAGE_WORDS = 120
+TURNS = 3
+TICK = 0.005
+
+words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do',
+         'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'привет', 'мир']
+
+
+class StubEncoding:
+    '''
+    CPU-bound encoding that works offline (cost grows with length of text, GIL is released while working)
+    '''
+    def __init__(self, rounds=8):
+        self.rounds = rounds
+
+    def encode_ordinary(self, text):
+        data = text.encode('utf-8')
+        for _ in range(self.rounds):
+            zlib.compress(data, 9)
+        return list(range(len(text) // 4 + 1))
+
+
+def get_encoding():
+    try:
+        return tiktoken.get_encoding('cl100k_base'), 'tiktoken cl100k_base'
+    except Exception:
+        return StubEncoding(), 'stub (tiktoken cl100k_base could not be loaded)'
+
+def message(role):
+    return {"role": role, "content": ' '.join(random.choice(words) for _ in range(MESSAGE_WORDS))}
+
+def conversations():
+    random.seed(0)
+    return [[message('user' if i % 2 == 0 else 'assistant') for i in range(MESSAGES)] for _ in range(USERS)]
+
+async def monitor(lags, stop):
+    '''
+    Measure how late the event loop wakes up a coroutine sleeping for TICK seconds
+    '''
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+async def run(name, count):
+    chats = conversations()
+    lags, stop = [], asyncio.Event()
+    async def user(messages):
+        for _ in range(TURNS):
+            messages.append(message('user'))
+            await count(messages)
+            await asyncio.sleep(0)
+    task = asyncio.create_task(monitor(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*[user(messages) for messages in chats])
+    total = time.perf_counter() - start
+    stop.set()
+    await task
+    lags = sorted(lags) or [0]
+    print(f'{name:<14} total: {total:7.3f}s | loop lag mean: {statistics.mean(lags) * 1000:7.2f}ms, '
+          f'p99: {lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000:7.2f}ms, max: {lags[-1] * 1000:7.2f}ms')
+
+async def main():
+    encoding, name = get_encoding()
+    print(f'Encoding: {name}')
+    print(f'{USERS} users, {MESSAGES} messages of {MESSAGE_WORDS} words, {TURNS} turns\n')
+
+    async def before(messages):
+        return sum(len(encoding.encode_ordinary(f"{m['role']}: {m['content']}")) for m in messages)
+    await run('before', before)
+
+    async def after_cold(messages):
+        return await TokenCounter(encoding).count(messages)
+    await run('after (cold)', after_cold)
+
+    counter = TokenCounter(encoding, maxsize=USERS * (MESSAGES + TURNS) * 2)
+    await run('after (warm)', counter.count)
+    print(f'\nToken cache: {counter.cache.info()}')
+
+if __name__ == '__main__':
+    asyncio.run(main())
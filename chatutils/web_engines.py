@@ -23,9 +23,75 @@ import os
 import asyncio
 import json
 import time
-import aiohttp
 import urllib.parse
 from bs4 import BeautifulSoup
+from chatutils.http_session import HTTPClient
+from chatutils.caching import TTLCache
+
+# Shared session for web tools: connections, TLS sessions and DNS results are reused between calls
+web_client = HTTPClient(
+    limit=config.getint("Web", "MaxConnections", fallback=50),
+    limit_per_host=config.getint("Web", "MaxConnectionsPerHost", fallback=4),
+    keepalive_timeout=config.getfloat("Web", "KeepAlive", fallback=30),
+    ttl_dns_cache=config.getint("Web", "DNSCacheTTL", fallback=300),
+    timeout=config.getfloat("Web", "Timeout", fallback=20),
+    connect_timeout=config.getfloat("Web", "ConnectTimeout", fallback=5),
+)
+
+# Cache of search results and parsed pages: popular queries and pages are not requested (and parsed) again
+# until they expire (CacheTTL = 0 disables the cache), it can be saved to disk between restarts
+web_cache = TTLCache(
+    maxsize=config.getint("Web", "CacheSize", fallback=1000),
+    ttl=config.getfloat("Web", "CacheTTL", fallback=3600),
+)
+web_cache_location = config.get("Web", "CacheLocation", fallback=None)
+
+def normalize_query(query) -> str:
+    '''
+    Normalize search query for cache key (case and whitespace are ignored)
+    '''
+    return ' '.join(str(query).lower().split())
+
+def canonical_url(url) -> str:
+    '''
+    Canonical URL for cache key: lowercase scheme and host, no default port, no fragment, sorted query
+    '''
+    try:
+        parts = urllib.parse.urlsplit(str(url).strip())
+        scheme = parts.scheme.lower() or 'http'
+        netloc = parts.netloc.lower()
+        if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+            netloc = netloc.rsplit(':', 1)[0]
+        query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+        return urllib.parse.urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+    except ValueError:
+        return str(url)
+
+async def start_web_session() -> None:
+    '''
+    Create shared session and load saved cache (on application startup)
+    '''
+    web_client.get_session()
+    if web_cache_location is not None and web_cache.ttl > 0:
+        try:
+            loaded = await asyncio.to_thread(web_cache.load, web_cache_location)
+            logger.info(f'Loaded {loaded} web cache items from {web_cache_location}')
+        except Exception as e:
+            logger.error(f'Could not load web cache from {web_cache_location}: {e}')
+    logger.info('Web session was started')
+
+async def close_web_session() -> None:
+    '''
+    Close shared session and save cache (on application shutdown)
+    '''
+    await web_client.close()
+    logger.info(f'Web cache statistics: {web_cache.info()}')
+    if web_cache_location is not None and web_cache.ttl > 0:
+        try:
+            await asyncio.to_thread(web_cache.save, web_cache_location)
+        except Exception as e:
+            logger.error(f'Could not save web cache to {web_cache_location}: {e}')
+    logger.info('Web session was closed')
 
 class GoogleEngine:
     '''
@@ -59,12 +125,19 @@ class GoogleEngine:
             "num": self.search_results
         }
         try:
-            logger.debug(f'Searching for: "{query}". Results number: {self.search_results}')
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.base_url, params=params) as response:
-                    data = await response.json()
-                    data = await self.format_data(data)
+            key = f'search:{self.search_results}:{normalize_query(query)}'
+            if web_cache.ttl > 0:
+                data = web_cache.get(key)
+                if data is not None:
+                    logger.debug(f'Search results for "{query}" were found in cache')
                     return data
+            logger.debug(f'Searching for: "{query}". Results number: {self.search_results}')
+            response = await web_client.get(self.base_url, params=params)
+            data = response.json()
+            data = await self.format_data(data)
+            if web_cache.ttl > 0 and response.status_code == 200:
+                web_cache.put(key, data)
+            return data
         except Exception as e:
             logger.error(f'Error while searching: {e}')
             return None
@@ -98,11 +171,18 @@ class URLOpen:
 
     async def open_url(self, url):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    data = await response.text()
-                    data = await self.parse_data(data)
+            # parsed text is cached, so the page is neither downloaded nor parsed again
+            key = f'url:{canonical_url(url)}'
+            if web_cache.ttl > 0:
+                data = web_cache.get(key)
+                if data is not None:
+                    logger.debug(f'Content of {url} was found in cache')
                     return data
+            response = await web_client.get(url)
+            data = await self.parse_data(response.text)
+            if web_cache.ttl > 0 and data is not None and response.status_code == 200:
+                web_cache.put(key, data)
+            return data
         except Exception as e:
             logger.error(f'Error while opening URL: {e}')
             return None
@@ -110,5 +190,9 @@ class URLOpen:
 if __name__ == "__main__":
     urlopener = URLOpen()
     url = 'https://www.wikipedia.org/'
-    data = asyncio.run(urlopener.open_url(url))
+    async def main():
+        data = await urlopener.open_url(url)
+        await close_web_session()
+        return data
+    data = asyncio.run(main())
     print(data)
\ No newline at end of file
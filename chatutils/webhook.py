@@ -0,0 +1,151 @@
+# Description: Webhook mode for SirChatalot (updates are received by a local HTTP server)
+
+import configparser
+config = configparser.ConfigParser()
+config.read('./data/.config', encoding='utf-8')
+LogLevel = config.get("Logging", "LogLevel") if config.has_option("Logging", "LogLevel") else "WARNING"
+
+# logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+logger = logging.getLogger("SirChatalot-Webhook")
+LogLevel = getattr(logging, LogLevel.upper())
+logger.setLevel(LogLevel)
+handler = TimedRotatingFileHandler('./logs/sirchatalot.log',
+                                       when="D",
+                                       interval=1,
+                                       backupCount=7,
+                                       encoding='utf-8')
+handler.setFormatter(logging.Formatter('%(name)s - %(asctime)s - %(levelname)s - %(message)s',"%Y-%m-%d %H:%M:%S"))
+logger.addHandler(handler)
+
+import time
+import signal
+import asyncio
+import secrets
+import hmac
+from aiohttp import web
+from telegram import Update
+
+
+class WebhookServer:
+    '''
+    HTTP server that receives updates from Telegram and puts them into the update queue of the application
+        * POST `path` - updates from Telegram (checked with secret token)
+        * GET `health_path` - health check for reverse proxy / orchestrator
+    The server is meant to be run behind a reverse proxy with TLS (Telegram sends updates only to HTTPS URLs).
+    '''
+    def __init__(self, application, url, listen="127.0.0.1", port=8080, path="/telegram", secret_token=None,
+                 max_connections=40, health_path="/health", set_webhook=True, on_startup=None, on_shutdown=None):
+        self.application = application
+        self.url = url # public HTTPS URL (may differ from local path behind reverse proxy)
+        self.listen = listen
+        self.port = port
+        self.path = '/' + path.lstrip('/')
+        self.health_path = '/' + health_path.lstrip('/')
+        # Telegram adds the token to every request, so requests from anybody else are rejected
+        # (random if not set, must be set explicitly if several workers share the same webhook)
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self.max_connections = max_connections
+        self.set_webhook = set_webhook
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+        self.started = None
+        self.received = 0
+
+    async def handle_update(self, request):
+        '''
+        Receive update from Telegram
+        '''
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, self.secret_token):
+            logger.warning(f'Webhook request with wrong secret token from {request.remote}')
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            logger.error(f'Could not parse update: {e}')
+            return web.Response(status=400)
+        # answer right away, update is processed by the application
+        await self.application.update_queue.put(update)
+        self.received += 1
+        return web.Response(status=200)
+
+    async def handle_health(self, request):
+        '''
+        Health check
+        '''
+        running = self.application.running
+        return web.json_response({
+            "status": "ok" if running else "stopped",
+            "uptime": round(time.monotonic() - self.started, 1) if self.started else 0,
+            "updates_received": self.received,
+            "updates_queued": self.application.update_queue.qsize(),
+        }, status=200 if running else 503)
+
+    async def run(self) -> None:
+        '''
+        Start application and HTTP server, wait for SIGINT/SIGTERM, then stop everything
+        '''
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get(self.health_path, self.handle_health)
+        runner = web.AppRunner(app, access_log=None)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                # Windows
+                pass
+
+        async with self.application:
+            if self.on_startup is not None:
+                await self.on_startup(self.application)
+            await self.application.start()
+            try:
+                await runner.setup()
+                site = web.TCPSite(runner, self.listen, self.port)
+                await site.start()
+                self.started = time.monotonic()
+                if self.set_webhook:
+                    await self.application.bot.set_webhook(
+                        url=self.url,
+                        secret_token=self.secret_token,
+                        max_connections=self.max_connections,
+                        allowed_updates=Update.ALL_TYPES,
+                    )
+                logger.info(f'Webhook server is listening on {self.listen}:{self.port}{self.path}, webhook URL: {self.url}')
+                print(f'Webhook server is listening on {self.listen}:{self.port}{self.path}')
+                await stop.wait()
+            finally:
+                logger.info('Stopping webhook server')
+                # stop receiving updates, then process the ones in the queue and stop background tasks
+                await runner.cleanup()
+                await self.application.stop()
+                if self.on_shutdown is not None:
+                    await self.on_shutdown(self.application)
+
+
+def get_webhook_server(application, on_startup=None, on_shutdown=None):
+    '''
+    Get webhook server if webhook mode is configured ([Webhook] section with URL), otherwise None
+    '''
+    if not config.has_option("Webhook", "URL"):
+        return None
+    return WebhookServer(
+        application,
+        url=config.get("Webhook", "URL"),
+        listen=config.get("Webhook", "Listen", fallback="127.0.0.1"),
+        port=config.getint("Webhook", "Port", fallback=8080),
+        path=config.get("Webhook", "Path", fallback="/telegram"),
+        secret_token=config.get("Webhook", "SecretToken", fallback=None),
+        max_connections=config.getint("Webhook", "MaxConnections", fallback=40),
+        health_path=config.get("Webhook", "HealthPath", fallback="/health"),
+        set_webhook=config.getboolean("Webhook", "SetWebhook", fallback=True),
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
+    )
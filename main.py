@@ -8,9 +8,8 @@ import time
 from telegram import ForceReply, Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
 from telegram.constants import ChatAction
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 import codecs
-import pickle
 from functools import wraps
 from datetime import datetime
 
@@ -18,7 +17,6 @@ from datetime import datetime
 from PIL import Image
 import base64
 import io
-import json
 
 # import configuration
 import configparser
@@ -88,6 +86,13 @@ else:
 # Check if bot should reply to message
 message_reply = config.getboolean("Telegram", "ReplyToMessage", fallback=False)
 
+# Check if answers should be streamed (message is edited while answer is generated)
+streaming = config.getboolean("Telegram", "Streaming", fallback=False)
+stream_edit_interval = config.getfloat("Telegram", "StreamEditInterval", fallback=1.0)
+
+# Max number of updates processed at once (updates of the same user are always processed in order)
+concurrent_updates = max(config.getint("Telegram", "ConcurrentUpdates", fallback=64), 1)
+
 # check if file functionality is enabled
 if config.has_section('Files'):
     files_enabled = True
@@ -147,12 +152,19 @@ from chatutils.processing import ChatProc
 text_engine = config.get("Telegram", "TextEngine") if config.has_option("Telegram", "TextEngine") else "OpenAI"
 speech_engine = config.get("Telegram", "SpeechEngine") if config.has_option("Telegram", "SpeechEngine") else "OpenAI"
 gpt = ChatProc(text=text_engine, speech=speech_engine) # speech can be None if you don't want to use speech2text
+
+from chatutils.ratelimit import RateLimiter
+rate_limiter = RateLimiter(gpt.chat_store, ratelimit_time, snapshot_interval=config.getfloat("Telegram", "RateLimitSnapshotInterval", fallback=60)) if ratelimit_time else None
 VISION = gpt.vision
 IMAGE_GENERATION = gpt.image_generation
 SPEECH = gpt.speech_engine
 
 ################################## Authorization ###############################################
 
+from chatutils.access import AccessList
+whitelist = AccessList("./data/whitelist.txt") if accesscodes is not None else None
+banlist = AccessList("./data/banlist.txt") if banlist_enabled else None
+
 def check_code(code, user_id) -> bool:
     '''
     Check if code is in accesscodes
@@ -161,8 +173,7 @@ def check_code(code, user_id) -> bool:
     try:
         if code in accesscodes:
             # add user to whitelist if code is correct
-            with codecs.open("./data/whitelist.txt", "a", "utf-8") as f:
-                f.write(str(user_id)+'\n')
+            whitelist.add(user_id)
             logger.info('Granted access to user with ID: ' + str(user_id) + '. Code used: ' + code)
             return True
     except Exception as e:
@@ -173,32 +184,10 @@ async def check_user(update, message=None, check_rate=True) -> bool:
     '''
     Check if user has an access
     '''
-    # read banlist
-    if banlist_enabled:
-        try:
-            with codecs.open("./data/banlist.txt", "r", "utf-8") as f:
-                # Read the contents of the file into a list
-                lines = f.readlines()
-            banlist = [line.rstrip('\n') for line in lines]
-        except:
-            logger.exception('No banlist or it is not possible to read it')
-            banlist = []
-
-    # read whitelist
-    if accesscodes is not None:
-        try:
-            with codecs.open("./data/whitelist.txt", "r", "utf-8") as f:
-                # Read the contents of the file into a list
-                lines = f.readlines()
-            whitelist = [line.rstrip('\n') for line in lines]
-        except:
-            logger.warning('No whitelist or it is not possible to read it')
-            whitelist = []
-
     user = update.effective_user
     # check if user is in banlist
     if banlist_enabled:
-        if str(user.id) in banlist:
+        if user.id in banlist:
             logger.warning("Restricted access to banned user: " + str(user))
             await update.message.reply_text("You are banned.")
             return False
@@ -208,7 +197,7 @@ async def check_user(update, message=None, check_rate=True) -> bool:
         return True
 
     # check if user is in whitelist
-    if str(user.id) not in whitelist:
+    if user.id not in whitelist:
         # if not, check if user sent access code
         if message is not None:
             if check_code(message, user.id):
@@ -251,15 +240,27 @@ def is_authorized(func):
         check_rate = False
     @wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        # check if user is in whitelist
-        text = update.message.text if update.message is not None else None
-        access = await check_user(update, text, check_rate=check_rate)
-        logger.debug(f'Checking access for function {func_called}, rate check is {check_rate}, access is {access}')
-        # if not, return
-        if access != True:
-            return
-        # if yes, run the function
-        return await func(update, context, *args, **kwargs)
+        # updates of the same user are processed in order (updates of different users are processed concurrently)
+        async with gpt.user_lock(update.effective_user.id):
+            # check if user is in whitelist
+            text = update.message.text if update.message is not None else None
+            access = await check_user(update, text, check_rate=check_rate)
+            logger.debug(f'Checking access for function {func_called}, rate check is {check_rate}, access is {access}')
+            # if not, return
+            if access != True:
+                return
+            # if yes, run the function
+            return await func(update, context, *args, **kwargs)
+    return wrapped
+
+def user_ordered(func):
+    '''
+    Process updates of the same user in order (for handlers without access check)
+    '''
+    @wraps(func)
+    async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        async with gpt.user_lock(update.effective_user.id):
+            return await func(update, context, *args, **kwargs)
     return wrapped
 
 ################################## Commands ###################################################
@@ -301,39 +302,18 @@ async def ratelimiter(user_id, check=False):
             limit = int(ratelimit_general)
 
     try:
-        # open the pickle file with the dict if exists
-        try:
-            if os.path.exists('./data/tech/ratelimit.pickle'):
-                with open('./data/tech/ratelimit.pickle', 'rb') as f:
-                    rate = pickle.load(f)
-            else:
-                logger.info('No ratelimit.pickle file found. Creating a new one.')
-                rate = {}
-                with open('./data/tech/ratelimit.pickle', 'wb') as f:
-                    pickle.dump(rate, f)
-        except Exception as e:
-            logger.error(f'Error while opening ratelimit.pickle. Error: {e}')
-            rate = {}
-        
-        # create a function to check if user is in the dict
-        if user_id not in rate:
-            rate[user_id] = []
-        # delete old values from the list 
-        if len(rate[user_id]) > 0:
-            rate[user_id] = [x for x in rate[user_id] if x > time.time() - ratelimit_time]
-            # if the list is longer than the limit, return False
-            if (len(rate[user_id]) > limit) and check != True:
-                return False
+        # number of messages of the user within the rate limit window
+        used = rate_limiter.count(user_id)
+        # if the list is longer than the limit, return False
+        if (used > limit) and check != True:
+            return False
         # add new value to the list
         if not check:
-            rate[user_id].append(time.time())
-        # save the dict to a pickle file
-        with open('./data/tech/ratelimit.pickle', 'wb') as f:
-            pickle.dump(rate, f)
+            used = rate_limiter.add(user_id)
         if check: 
-            if len(rate[user_id]) > limit:
+            if used > limit:
                 return f"Rate limit of {limit} messages per {ratelimit_time} seconds exceeded. Please wait."
-            return f"You have used your limit of {len(rate[user_id])}/{limit} messages per {ratelimit_time} seconds."
+            return f"You have used your limit of {used}/{limit} messages per {ratelimit_time} seconds."
         return True
     except Exception as e:
         logger.exception('Could not create rate limiter. Rate is not limited.')
@@ -407,8 +387,98 @@ async def send_message(update: Update, text, max_length=4096, markdown=0):
     except Exception as e:
         logger.exception('Could not send message to user: ' + str(update.effective_user.id))
 
+class StreamingReply:
+    '''
+    Answer that is shown to user while it is generated
+    The first part of the answer is sent as a new message, then the message is edited
+    at most once per `interval` seconds. Text longer than `max_length` is continued in a new message.
+    '''
+    def __init__(self, update: Update, interval=1.0, max_length=4096):
+        self.update = update
+        self.interval = interval
+        self.max_length = max_length
+        self.text = ''
+        self.messages = [] # sent messages
+        self.shown = [] # text of each sent message
+        self.edited = 0
+
+    async def show(self, index, text, markdown=False) -> None:
+        '''
+        Send or edit message with a given index
+        '''
+        if index < len(self.shown) and self.shown[index] == text:
+            return None
+        parse_mode = 'Markdown' if markdown else None
+        if index < len(self.messages):
+            try:
+                await self.messages[index].edit_text(text, parse_mode=parse_mode)
+            except BadRequest as e:
+                if 'not modified' not in str(e).lower():
+                    raise
+            self.shown[index] = text
+        else:
+            reply_to = self.update.message.message_id if index == 0 and message_reply else None
+            self.messages.append(await self.update.message.reply_text(text, parse_mode=parse_mode, reply_to_message_id=reply_to))
+            self.shown.append(text)
+
+    async def push(self, delta) -> None:
+        '''
+        Add part of answer, message is updated if `interval` passed since the last update
+        '''
+        self.text += delta
+        if time.monotonic() - self.edited < self.interval or not self.text.strip():
+            return None
+        self.edited = time.monotonic()
+        try:
+            parts = [self.text[i:i+self.max_length] for i in range(0, len(self.text), self.max_length)]
+            for index in range(max(len(self.messages) - 1, 0), len(parts)):
+                await self.show(index, parts[index])
+        except RetryAfter as e:
+            # flood control, next update is postponed
+            self.edited = time.monotonic() + e.retry_after
+            logger.debug(f'Streaming is postponed for {e.retry_after} seconds')
+        except Exception as e:
+            logger.debug(f'Could not update streamed message: {e}')
+
+    async def finish(self, text) -> bool:
+        '''
+        Replace streamed text with the final answer (Markdown if possible)
+        Returns False if nothing was shown to user (answer should be sent as usual)
+        '''
+        if not self.messages:
+            return False
+        parts = [text[i:i+self.max_length] for i in range(0, len(text), self.max_length)] or ['...']
+        for index, part in enumerate(parts):
+            try:
+                await self.show(index, part, markdown=True)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                await self.show(index, part)
+            except Exception as e:
+                logger.debug(f'(!) Error sending streamed message with markdown ({e}): {part}')
+                try:
+                    await self.show(index, part)
+                except Exception as e:
+                    logger.exception('Could not send streamed message to user: ' + str(self.update.effective_user.id))
+        # remove messages that are not needed anymore (e.g. final answer is shorter)
+        await self.discard(start=len(parts))
+        return True
+
+    async def discard(self, start=0) -> None:
+        '''
+        Delete streamed messages starting from a given index
+        '''
+        for message in self.messages[start:]:
+            try:
+                await message.delete()
+            except Exception as e:
+                logger.debug(f'Could not delete streamed message: {e}')
+        del self.messages[start:]
+        del self.shown[start:]
+
 ################################## Commands ###################################################
 
+@user_ordered
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''
     Send a message when the command /start is issued.
@@ -526,12 +596,7 @@ async def delete_files_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
         deleted = await gpt.files_rag.remove_text_user(user_id)
         
-        with codecs.open('./data/files/files.json', 'r', 'utf-8') as f:
-            files = json.load(f)
-        if str(user_id) in files:
-            del files[str(user_id)]
-        with codecs.open('./data/files/files.json', 'w', 'utf-8') as f:
-            json.dump(files, f)
+        await gpt.file_catalog.delete(user_id)
 
         logger.info(f'Files for user {user_id} were deleted. RAG removed: {deleted}')
         if deleted:
@@ -585,7 +650,8 @@ async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await application.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
 
     message = update.message.text
-    answer = await gpt.chat(id=update.effective_user.id, message=message)
+    reply = StreamingReply(update, interval=stream_edit_interval) if streaming else None
+    answer = await gpt.chat(id=update.effective_user.id, message=message, on_delta=reply.push if reply is not None else None)
     
     # DEBUG
     logger.debug(f'>> Username: {update.effective_user.username}. Message: {update.message.text}')
@@ -601,10 +667,14 @@ async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if answer[0] == 'image':
             logger.debug(f'<< Username: {update.effective_user.username}. Answer - Image ({answer[2]}')
             image_bytes = base64.b64decode(answer[1])
+            if reply is not None:
+                await reply.discard()
             await update.message.reply_photo(photo=image_bytes)
 
             return None
     logger.debug(f'<< Username: {update.effective_user.username}. Answer: {answer}')
+    if reply is not None and await reply.finish(answer):
+        return None
     await send_message(update, answer, markdown=1)
 
 @is_authorized
@@ -800,16 +870,7 @@ async def downloader(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text = text[:4096] + '...'
         summary, _ = await gpt.text_engine.summary(text, size=160)
 
-        if os.path.exists('./data/files/files.json'):
-            with codecs.open('./data/files/files.json', 'r', 'utf-8') as f:
-                files = json.load(f) 
-        else:
-            files = {}
-        if user_id_str not in files:
-            files[user_id_str] = {}
-        files[user_id_str][filename] = {'summary': summary, 'processed': processed}
-        with codecs.open('./data/files/files.json', 'w', 'utf-8') as f:
-            json.dump(files, f, ensure_ascii=False, indent=4)
+        await gpt.file_catalog.upsert(user_id_str, filename, {'summary': summary, 'processed': processed})
 
         await m.edit_text(f"File {filename} was processed.\n\nSummary:\n{summary}")
         
@@ -965,21 +1026,15 @@ async def process_files_on_start(files_dir='./data/files/common'):
             logger.info(f'Files directory {files_dir} not found.')
             return None
         
-        if not os.path.exists('./data/files/files.json'):
-            with codecs.open('./data/files/files.json', 'w', 'utf-8') as f:
-                json.dump({}, f)
-        with codecs.open('./data/files/files.json', 'r', 'utf-8') as f:
-            files = json.load(f)
-        if 'common' not in files:
-            files['common'] = {} 
-        logger.info(f'Files found in common directory: {len(os.listdir(files_dir))}; Processed: {len(files["common"])}')
+        common_files = gpt.file_catalog.get('common')
+        logger.info(f'Files found in common directory: {len(os.listdir(files_dir))}; Processed: {len(common_files)}')
 
         for file in os.listdir(files_dir):
             file_path = os.path.join(files_dir, file)
 
             # Check if already processed
-            if file in files['common']:
-                if files['common'][file]['processed']:
+            if file in common_files:
+                if common_files[file]['processed']:
                     logger.info(f'- File {file} was already processed into RAG dataset (COMMON).')
                     continue
 
@@ -995,22 +1050,37 @@ async def process_files_on_start(files_dir='./data/files/common'):
                 text = text[:4096] + '...'
             summary, _ = await gpt.text_engine.summary(text, size=160)
 
-            files['common'][file] = {'summary': summary, 'processed': processed}
-            with codecs.open('./data/files/files.json', 'w', 'utf-8') as f:
-                json.dump(files, f, ensure_ascii=False, indent=4)
+            await gpt.file_catalog.upsert('common', file, {'summary': summary, 'processed': processed})
 
             logger.info(f'File {file} was processed into RAG dataset (COMMON).')
     except Exception as e:
         logger.exception(f'Error processing common files: {e}')
         return None
 
+async def on_startup(application: Application) -> None:
+    '''
+    Start background tasks when the bot is started
+    '''
+    await gpt.start()
+    if rate_limiter is not None:
+        await rate_limiter.start()
+
+async def on_shutdown(application: Application) -> None:
+    '''
+    Stop background tasks and write pending changes to disk when the bot is stopped
+    '''
+    if rate_limiter is not None:
+        await rate_limiter.stop()
+    await gpt.stop()
+
 def main() -> None:
     '''
     Start the bot.
     '''
     global application
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TOKEN).build()
+    # updates of different users are processed concurrently (at most `concurrent_updates` at once)
+    application = Application.builder().token(TOKEN).concurrent_updates(concurrent_updates).post_init(on_startup).post_shutdown(on_shutdown).build()
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
@@ -1051,7 +1121,13 @@ def main() -> None:
     loop.run_until_complete(process_files_on_start())
 
     # Run the bot until the Ctrl-C is pressed
-    application.run_polling()
+    # (updates are received with webhook if [Webhook] section is set, otherwise with long polling)
+    from chatutils.webhook import get_webhook_server
+    webhook = get_webhook_server(application, on_startup=on_startup, on_shutdown=on_shutdown)
+    if webhook is not None:
+        loop.run_until_complete(webhook.run())
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+'''
+Concurrent YandexGPT requests go through one shared HTTP session and do not block each other
+Run from the root directory of the bot:
+    python -m pytest tests
+'''
+import asyncio
+import time
+
+from aiohttp import web
+
+import chatutils.engines as engines
+from chatutils.http_session import get_http_client, close_http_client
+
+CALLS = 5
+DELAY = 0.5
+
+
+class WordEncoding:
+    '''
+    Encoding for token estimates (cl100k_base is downloaded by tiktoken, the test does not use network)
+    '''
+    def encode_ordinary(self, text):
+        return text.split()
+
+
+def write_config(path, endpoint):
+    path.mkdir(parents=True, exist_ok=True)
+    (path / '.config').write_text(
+        '[YandexGPT]\n'
+        'SecretKey = test\n'
+        'CatalogID = test\n'
+        f'Endpoint = {endpoint}\n',
+        encoding='utf-8')
+
+
+def test_concurrent_chats_share_session(tmp_path, monkeypatch):
+    state = {"active": 0, "peak": 0, "peers": set()}
+
+    async def completion(request):
+        state["active"] += 1
+        state["peak"] = max(state["peak"], state["active"])
+        state["peers"].add(request.transport.get_extra_info('peername'))
+        try:
+            await asyncio.sleep(DELAY)
+        finally:
+            state["active"] -= 1
+        return web.json_response({"result": {
+            "alternatives": [{"message": {"role": "assistant", "text": "Hi"}}],
+            "usage": {"inputTextTokens": "1", "completionTokens": "1"},
+        }})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post('/completion', completion)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        try:
+            write_config(tmp_path / 'data', f'http://{host}:{port}/completion')
+            monkeypatch.chdir(tmp_path)
+            monkeypatch.setattr(engines.tiktoken, 'get_encoding', lambda name: WordEncoding())
+            engine = engines.YandexEngine(text=True)
+            assert engine.http is get_http_client()
+
+            async def chat(id):
+                return await engine.chat(id=id, messages=[{"role": "user", "content": "Hello"}])
+
+            start = time.monotonic()
+            first = await asyncio.gather(*[chat(id) for id in range(CALLS)])
+            elapsed = time.monotonic() - start
+            session = engine.http.session
+            second = await asyncio.gather(*[chat(id) for id in range(CALLS)])
+            return first + second, elapsed, session, engine.http.session
+        finally:
+            await close_http_client()
+            await runner.cleanup()
+
+    results, elapsed, session, session_after = asyncio.run(run())
+
+    assert [response for response, _, _ in results] == ['Hi'] * CALLS * 2
+    assert all(usage == {"prompt": 1, "completion": 1} for _, _, usage in results)
+    # requests overlapped instead of waiting for each other
+    assert state["peak"] == CALLS
+    assert elapsed < DELAY * 2
+    # one session for all calls, connections of the first round were reused by the second one
+    assert session is not None and session is session_after
+    assert len(state["peers"]) <= CALLS
@@ -0,0 +1,81 @@
+'''
+Write-behind flushes write only new or changed messages
+Run from the root directory of the bot:
+    python -m pytest tests
+'''
+import asyncio
+import pickle
+
+from chatutils.storage import AppendLogChatStore, SQLiteChatStore, WriteBehind
+
+
+def read_records(store, id):
+    records = []
+    with open(store.path(id), "rb") as f:
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except EOFError:
+                return records
+
+
+def chat():
+    return [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Hi"},
+    ]
+
+
+async def add_and_flush(write_behind, messages):
+    write_behind.chat_changed(1, messages)
+    await write_behind.flush()
+    messages.append({"role": "user", "content": "How are you?"})
+    write_behind.chat_changed(1, messages)
+    await write_behind.flush()
+    # system message is changed in place
+    messages[0]['content'] = 'You are a pirate.'
+    write_behind.chat_changed(1, messages, index=0)
+    await write_behind.flush()
+
+
+def test_log_store_writes_only_delta(tmp_path):
+    store = AppendLogChatStore(location=str(tmp_path / 'chats'), legacy_location=None)
+    messages = chat()
+    asyncio.run(add_and_flush(WriteBehind(store, {}), messages))
+
+    records = read_records(store, 1)
+    assert [record[0] for record in records] == ['set', 'extend', 'update']
+    assert records[1] == ('extend', [{"role": "user", "content": "How are you?"}])
+    assert records[2] == ('update', 0, {"role": "system", "content": "You are a pirate."})
+    assert store.load(1) == messages
+
+
+def test_sqlite_store_writes_only_delta(tmp_path):
+    store = SQLiteChatStore(location=str(tmp_path / 'sirchatalot.db'))
+    statements = []
+    store.conn.set_trace_callback(statements.append)
+    messages = chat()
+    write_behind = WriteBehind(store, {})
+
+    async def run():
+        write_behind.chat_changed(1, messages)
+        await write_behind.flush()
+        statements.clear()
+        messages.append({"role": "user", "content": "How are you?"})
+        write_behind.chat_changed(1, messages)
+        await write_behind.flush()
+        added = list(statements)
+        statements.clear()
+        messages[0]['content'] = 'You are a pirate.'
+        write_behind.chat_changed(1, messages, index=0)
+        await write_behind.flush()
+        return added, list(statements)
+
+    added, updated = asyncio.run(run())
+    writes = lambda statements: [s.split()[0] for s in statements if s.split()[0] in ('INSERT', 'UPDATE', 'DELETE')]
+    assert writes(added) == ['INSERT']
+    assert ', 3, ' in next(s for s in added if s.startswith('INSERT'))
+    assert writes(updated) == ['UPDATE']
+    store.forget(1)
+    assert store.load(1) == messages